@@ -0,0 +1,66 @@
+# Сравнение скорости разбора времени напоминаний:
+# прямой вызов dateparser.parse (как раньше в handle_message) и ReminderTimeParser.
+# Запуск: python benchmarks/bench_parse.py [--rounds 200]
+import argparse
+import os
+import sys
+import time
+
+import dateparser
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from tg_bot import DEFAULT_TIMEZONE, DEFAULT_TIMEZONE_NAME, ReminderTimeParser  # noqa: E402
+
+SAMPLES = [
+    "завтра в 10:00",
+    "сегодня в 18:30",
+    "25.12 18:30",
+    "01.01.2030 09:00",
+    "через 2 часа",
+    "через 15 минут",
+    "19:45",
+    "в пятницу в 12:00",
+    "15 марта в 9:30",
+    "через полчаса",
+]
+
+
+def measure(parse, rounds):
+    timings = []
+    for _ in range(rounds):
+        for text in SAMPLES:
+            started = time.perf_counter()
+            parse(text)
+            timings.append(time.perf_counter() - started)
+    timings.sort()
+    return {
+        'avg_us': sum(timings) / len(timings) * 1e6,
+        'p50_us': timings[len(timings) // 2] * 1e6,
+        'p99_us': timings[int(len(timings) * 0.99)] * 1e6,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--rounds', type=int, default=200)
+    args = parser.parse_args()
+
+    started = time.perf_counter()
+    dateparser.parse("завтра в 10:00", languages=['ru'], settings={'TIMEZONE': DEFAULT_TIMEZONE_NAME})
+    print(f"Первый вызов dateparser: {(time.perf_counter() - started) * 1e3:.1f} мс")
+
+    before = measure(lambda text: dateparser.parse(text, languages=['ru'], settings={'TIMEZONE': DEFAULT_TIMEZONE_NAME}),
+                     args.rounds)
+    time_parser = ReminderTimeParser(DEFAULT_TIMEZONE)
+    time_parser.warm_up()
+    after = measure(time_parser.parse, args.rounds)
+
+    print(f"{'':<22}{'avg, мкс':>12}{'p50, мкс':>12}{'p99, мкс':>12}")
+    for name, result in (("dateparser.parse", before), ("ReminderTimeParser", after)):
+        print(f"{name:<22}{result['avg_us']:>12.1f}{result['p50_us']:>12.1f}{result['p99_us']:>12.1f}")
+    print(f"Ускорение (avg): {before['avg_us'] / after['avg_us']:.1f}x")
+    print(f"Быстрый путь: {time_parser.fast_hits}, кэш: {time_parser.memo_hits}, вызовов dateparser: {time_parser.dateparser_calls}")
+
+
+if __name__ == '__main__':
+    main()
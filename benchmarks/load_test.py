@@ -0,0 +1,238 @@
+# Нагрузочный тест бота: настоящие обработчики tg_bot.py (start, button, handle_message, check_reminders)
+# получают синтетические обновления от тысяч пользователей, а запросы к Bot API уходят на локальный
+# поддельный сервер. База - DATABASE_URL (используйте отдельную тестовую базу)
+# или файл SQLite при STORAGE_BACKEND=sqlite SQLITE_PATH=load_test.db.
+# Запуск: python benchmarks/load_test.py [--users 1000] [--concurrency 100] [--reminders 2000]
+import argparse
+import asyncio
+import itertools
+import json
+import os
+import sys
+import time
+from datetime import datetime, timedelta, timezone
+
+from aiohttp import web
+
+# Тестовые пользователи берутся из отдельного диапазона id, чтобы их данные можно было удалить после теста
+USER_ID_BASE = 9_000_000_000
+TOKEN = "123456:load-test"
+
+
+def percentile(values, q):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * q))]
+
+
+def format_timings(values):
+    return (f"n={len(values):<7} p50={percentile(values, 0.50) * 1e3:8.2f} мс "
+            f"p95={percentile(values, 0.95) * 1e3:8.2f} мс p99={percentile(values, 0.99) * 1e3:8.2f} мс")
+
+
+# Поддельный Bot API: отвечает на методы, которые вызывает бот, и запоминает время получения напоминаний
+class FakeBotApi:
+    def __init__(self, latency):
+        self.latency = latency
+        self.message_ids = itertools.count(1)
+        self.calls = {}
+        self.reminder_lags = []
+
+    async def handle(self, request):
+        method = request.match_info['method']
+        self.calls[method] = self.calls.get(method, 0) + 1
+        if request.content_type == 'application/json':
+            params = await request.json()
+        else:
+            params = dict(await request.post())
+        if self.latency:
+            await asyncio.sleep(self.latency)
+
+        if method == 'getMe':
+            result = {'id': 1, 'is_bot': True, 'first_name': 'Load test', 'username': 'load_test_bot'}
+        elif method in ('sendMessage', 'editMessageText'):
+            text = params.get('text', '')
+            marker = text.rsplit('lt:', 1)
+            if method == 'sendMessage' and len(marker) == 2:
+                self.reminder_lags.append(time.time() - float(marker[1]))
+            chat_id = int(params.get('chat_id') or USER_ID_BASE)
+            result = {
+                'message_id': next(self.message_ids),
+                'date': int(time.time()),
+                'chat': {'id': chat_id, 'type': 'private'},
+                'text': text,
+            }
+        else:
+            result = True
+        return web.json_response({'ok': True, 'result': result})
+
+    async def start(self, port):
+        app = web.Application()
+        app.router.add_post('/bot{token}/{method}', self.handle)
+        runner = web.AppRunner(app)
+        await runner.setup()
+        await web.TCPSite(runner, '127.0.0.1', port).start()
+        return runner
+
+
+# Генератор обновлений в формате Bot API
+class UpdateFactory:
+    def __init__(self):
+        self.update_ids = itertools.count(1)
+        self.message_ids = itertools.count(1)
+
+    def user(self, user_id):
+        return {'id': user_id, 'is_bot': False, 'first_name': f"user{user_id}"}
+
+    def message(self, user_id, text):
+        message = {
+            'message_id': next(self.message_ids),
+            'date': int(time.time()),
+            'chat': {'id': user_id, 'type': 'private'},
+            'from': self.user(user_id),
+            'text': text,
+        }
+        if text.startswith('/'):
+            message['entities'] = [{'type': 'bot_command', 'offset': 0, 'length': len(text.split()[0])}]
+        return {'update_id': next(self.update_ids), 'message': message}
+
+    def callback(self, user_id, data):
+        return {
+            'update_id': next(self.update_ids),
+            'callback_query': {
+                'id': str(next(self.update_ids)),
+                'from': self.user(user_id),
+                'chat_instance': str(user_id),
+                'data': data,
+                'message': {
+                    'message_id': next(self.message_ids),
+                    'date': int(time.time()),
+                    'chat': {'id': user_id, 'type': 'private'},
+                    'text': "Меню",
+                },
+            },
+        }
+
+
+# Сценарий одного пользователя: меню, заметки, просмотр заметок, напоминание, просмотр напоминаний
+def user_scenario(factory, user_id, notes_per_user):
+    yield 'start', factory.message(user_id, '/start')
+    for number in range(notes_per_user):
+        yield 'message', factory.message(user_id, "Добавить заметку")
+        yield 'message', factory.message(user_id, f"#tag{number % 3} заметка {number} пользователя {user_id}")
+    yield 'button:notes_menu', factory.callback(user_id, 'notes_menu')
+    yield 'button:all_tags', factory.callback(user_id, 'all_tags')
+    yield 'button:all_notes', factory.callback(user_id, 'all_notes')
+    yield 'button:all_tags', factory.callback(user_id, 'all_tags')
+    yield 'message', factory.message(user_id, "Добавить напоминание")
+    yield 'message', factory.message(user_id, "проверить почту - через 2 часа")
+    yield 'button:reminders_menu', factory.callback(user_id, 'reminders_menu')
+    yield 'button:today_reminders', factory.callback(user_id, 'today_reminders')
+
+
+async def run_updates(application, args):
+    from telegram import Update
+
+    factory = UpdateFactory()
+    timings = {}
+    semaphore = asyncio.Semaphore(args.concurrency)
+
+    async def run_user(user_id):
+        async with semaphore:
+            for kind, data in user_scenario(factory, user_id, args.notes_per_user):
+                update = Update.de_json(data, application.bot)
+                started = time.perf_counter()
+                await application.process_update(update)
+                timings.setdefault(kind, []).append(time.perf_counter() - started)
+
+    started = time.perf_counter()
+    await asyncio.gather(*(run_user(USER_ID_BASE + number) for number in range(args.users)))
+    elapsed = time.perf_counter() - started
+    total = sum(len(values) for values in timings.values())
+
+    print(f"\nОбработка обновлений: {total} за {elapsed:.2f} с, {total / elapsed:.0f} обновлений в секунду")
+    for kind in sorted(timings):
+        print(f"  {kind:<26}{format_timings(timings[kind])}")
+    print(f"  {'все':<26}{format_timings([value for values in timings.values() for value in values])}")
+
+
+async def run_reminders(bot, api, args):
+    # Напоминания с временем срабатывания в ближайшие секунды; в тексте - ожидаемое время для расчета задержки
+    due_at = time.time() + args.reminder_delay
+    now = datetime.now(timezone.utc)
+
+    async def add(number):
+        reminder_time = now + timedelta(seconds=args.reminder_delay)
+        user_id = USER_ID_BASE + number % max(args.users, 1)
+        text = f"нагрузочный тест lt:{due_at}"
+        reminder_id = await bot.run_db(bot.add_reminder, user_id, reminder_time, text)
+        bot.reminder_scheduler.add(reminder_id, user_id, reminder_time, text)
+
+    await asyncio.gather(*(add(number) for number in range(args.reminders)))
+    deadline = time.time() + args.reminder_delay + args.reminder_timeout
+    while len(api.reminder_lags) < args.reminders and time.time() < deadline:
+        await asyncio.sleep(0.1)
+    # Ждем последнего пакетного удаления из базы
+    await asyncio.sleep(bot.REMINDER_ACK_INTERVAL * 2)
+
+    lags = api.reminder_lags
+    print(f"\nДоставка напоминаний: {len(lags)} из {args.reminders}")
+    if lags:
+        print(f"  задержка p50={percentile(lags, 0.50):.3f} с p95={percentile(lags, 0.95):.3f} с "
+              f"p99={percentile(lags, 0.99):.3f} с max={max(lags):.3f} с")
+    print(f"  конвейер: {bot.reminder_delivery.stats()}")
+
+
+def cleanup(bot, users):
+    bot.delete_user_data([USER_ID_BASE + number for number in range(max(users, 1))])
+
+
+async def run(args):
+    import tg_bot as bot
+
+    api = FakeBotApi(args.api_latency / 1000)
+    runner = await api.start(args.port)
+    bot.init_db()
+    bot.reminder_time_parser.warm_up()
+    application = bot.build_application(TOKEN, base_url=f"http://127.0.0.1:{args.port}/bot")
+
+    await application.initialize()
+    await application.post_init(application)
+    await application.start()
+    try:
+        if args.users:
+            await run_updates(application, args)
+        if args.reminders:
+            await run_reminders(bot, api, args)
+        print(f"\nХранилище: {bot.get_storage().stats()}")
+        print(f"Кэш заметок: {bot.notes_cache.stats()}")
+        print(f"Вызовы Bot API: {json.dumps(api.calls, ensure_ascii=False)}")
+    finally:
+        await application.stop()
+        if not args.keep_data:
+            await bot.run_db(cleanup, bot, args.users)
+        await application.shutdown()
+        await application.post_shutdown(application)
+        await runner.cleanup()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--users', type=int, default=1000, help="число пользователей")
+    parser.add_argument('--concurrency', type=int, default=100, help="сколько пользователей активны одновременно")
+    parser.add_argument('--notes-per-user', type=int, default=5)
+    parser.add_argument('--reminders', type=int, default=2000, help="сколько напоминаний доставить")
+    parser.add_argument('--reminder-delay', type=float, default=3.0, help="через сколько секунд срабатывают напоминания")
+    parser.add_argument('--reminder-timeout', type=float, default=120.0)
+    parser.add_argument('--api-latency', type=float, default=0.0, help="задержка ответа Bot API, мс")
+    parser.add_argument('--port', type=int, default=8081)
+    parser.add_argument('--keep-data', action='store_true', help="не удалять данные тестовых пользователей")
+    args = parser.parse_args()
+
+    sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    asyncio.run(run(args))
+
+
+if __name__ == '__main__':
+    main()
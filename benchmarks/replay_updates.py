@@ -0,0 +1,50 @@
+# Отправка записанных обновлений Telegram на локальный вебхук бота (BOT_MODE=webhook).
+# Файл - JSON-массив обновлений или по одному обновлению в строке.
+# Запуск: python benchmarks/replay_updates.py updates.json [--url http://localhost:8080/telegram] [--concurrency 10]
+import argparse
+import asyncio
+import json
+import os
+import time
+
+import aiohttp
+
+
+def load_updates(path):
+    with open(path, encoding='utf-8') as f:
+        content = f.read().strip()
+    if content.startswith('['):
+        return json.loads(content)
+    return [json.loads(line) for line in content.splitlines() if line.strip()]
+
+
+async def replay(updates, url, secret_token, concurrency):
+    headers = {'X-Telegram-Bot-Api-Secret-Token': secret_token} if secret_token else {}
+    semaphore = asyncio.Semaphore(concurrency)
+    statuses = {}
+
+    async def post(session, update):
+        async with semaphore:
+            async with session.post(url, json=update, headers=headers) as response:
+                statuses[response.status] = statuses.get(response.status, 0) + 1
+
+    started = time.perf_counter()
+    async with aiohttp.ClientSession() as session:
+        await asyncio.gather(*(post(session, update) for update in updates))
+    elapsed = time.perf_counter() - started
+    print(f"Отправлено обновлений: {len(updates)} за {elapsed:.2f} с ({len(updates) / elapsed:.0f} в секунду)")
+    print(f"Ответы сервера: {statuses}")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('path')
+    parser.add_argument('--url', default=f"http://localhost:{os.getenv('WEBHOOK_PORT', '8080')}{os.getenv('WEBHOOK_PATH', '/telegram')}")
+    parser.add_argument('--secret-token', default=os.getenv('WEBHOOK_SECRET_TOKEN'))
+    parser.add_argument('--concurrency', type=int, default=10)
+    args = parser.parse_args()
+    asyncio.run(replay(load_updates(args.path), args.url, args.secret_token, args.concurrency))
+
+
+if __name__ == '__main__':
+    main()
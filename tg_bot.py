@@ -1,23 +1,236 @@
+import asyncio
+import bisect
+import csv
+import heapq
+import io
+import itertools
+import json
 import logging
+import multiprocessing
+import re
+import signal
+import sqlite3
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
 from datetime import datetime, timedelta, timezone
+from functools import lru_cache, partial, wraps
+from zoneinfo import ZoneInfo, ZoneInfoNotFoundError
+from aiohttp import web
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup, ReplyKeyboardMarkup
 from telegram.ext import Application, CommandHandler, CallbackQueryHandler, MessageHandler, filters, ApplicationBuilder
+from telegram.ext import BasePersistence, PersistenceInput
+from telegram.error import BadRequest, Forbidden, NetworkError, RetryAfter, TelegramError
 import dateparser
+from dateutil.rrule import rrulestr
 import os
 import psycopg2
-from psycopg2 import sql
+from psycopg2 import extras, sql
+from psycopg2 import pool as pg_pool
 
-# Функция для подключения к базе данных
+# Хранилище данных: postgres (DATABASE_URL) или sqlite (файл SQLITE_PATH, для небольших установок и тестов)
+STORAGE_BACKEND = os.getenv("STORAGE_BACKEND", "postgres")
+SQLITE_PATH = os.getenv("SQLITE_PATH", "organizer1.db")
+
+# Настройки пула соединений с базой данных
+DB_POOL_MIN_SIZE = int(os.getenv("DB_POOL_MIN_SIZE", "1"))
+DB_POOL_MAX_SIZE = int(os.getenv("DB_POOL_MAX_SIZE", "10"))
+DB_POOL_TIMEOUT = float(os.getenv("DB_POOL_TIMEOUT", "5"))
+DB_POOL_STATS_INTERVAL = float(os.getenv("DB_POOL_STATS_INTERVAL", "300"))
+
+# Через сколько повторить отправку напоминания после ошибки
+REMINDER_RETRY_DELAY = timedelta(seconds=60)
+
+# Настройки отправки напоминаний: размер очереди, число параллельных отправок, лимиты Telegram,
+# число попыток и период пакетного удаления отправленных напоминаний из базы
+REMINDER_QUEUE_SIZE = int(os.getenv("REMINDER_QUEUE_SIZE", "10000"))
+REMINDER_SEND_CONCURRENCY = int(os.getenv("REMINDER_SEND_CONCURRENCY", "8"))
+TELEGRAM_GLOBAL_RATE = float(os.getenv("TELEGRAM_GLOBAL_RATE", "25"))
+TELEGRAM_CHAT_INTERVAL = float(os.getenv("TELEGRAM_CHAT_INTERVAL", "1"))
+REMINDER_SEND_ATTEMPTS = int(os.getenv("REMINDER_SEND_ATTEMPTS", "5"))
+REMINDER_ACK_INTERVAL = float(os.getenv("REMINDER_ACK_INTERVAL", "1"))
+
+# Режим получения обновлений: polling (по умолчанию) или webhook
+BOT_MODE = os.getenv("BOT_MODE", "polling")
+# Публичный адрес вебхука для setWebhook; если не задан, сервер просто принимает POST-запросы (локальная проверка)
+WEBHOOK_URL = os.getenv("WEBHOOK_URL")
+WEBHOOK_LISTEN = os.getenv("WEBHOOK_LISTEN", "0.0.0.0")
+WEBHOOK_PORT = int(os.getenv("WEBHOOK_PORT", "8080"))
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "/telegram")
+WEBHOOK_SECRET_TOKEN = os.getenv("WEBHOOK_SECRET_TOKEN")
+# Сколько обновлений обрабатывать одновременно (0 - по одному, как раньше)
+BOT_CONCURRENT_UPDATES = int(os.getenv("BOT_CONCURRENT_UPDATES", "0"))
+
+# Состояние диалогов пользователей (user_data) хранится в базе: как часто записывать изменения пачкой
+# и через сколько секунд перечитывать состояние из базы (0 - не перечитывать, достаточно для одной копии бота;
+# при нескольких копиях, BOT_REPLICAS > 1, обязательно задайте 1-5 секунд)
+USER_STATE_FLUSH_INTERVAL = float(os.getenv("USER_STATE_FLUSH_INTERVAL", "1"))
+USER_STATE_REFRESH_TTL = float(os.getenv("USER_STATE_REFRESH_TTL", "0"))
+
+# Роль процесса: all - все в одном процессе (по умолчанию), updates - только обработка обновлений,
+# reminders - только отправка напоминаний. Напоминания делятся между REMINDER_SHARDS процессами
+# по user_id; номер части процесса - REMINDER_SHARD (если он не задан у роли reminders,
+# запускаются процессы для всех частей). В одном процессе (all, одна часть) напоминания планируются
+# в памяти, иначе процессы захватывают наступившие напоминания в базе с арендой на REMINDER_LEASE
+BOT_ROLE = os.getenv("BOT_ROLE", "all")
+REMINDER_SHARDS = int(os.getenv("REMINDER_SHARDS", "1"))
+REMINDER_SHARD = int(os.getenv("REMINDER_SHARD") or "0")
+REMINDER_POLL_INTERVAL = float(os.getenv("REMINDER_POLL_INTERVAL", "1"))
+REMINDER_CLAIM_BATCH = int(os.getenv("REMINDER_CLAIM_BATCH", "500"))
+REMINDER_LEASE = timedelta(seconds=float(os.getenv("REMINDER_LEASE", "300")))
+# Сколько одинаковых копий этого процесса (та же роль и часть) запущено. Несколько копий захватывают
+# напоминания из базы: иначе каждая загрузит в свой планировщик все напоминания и отправит их по разу
+BOT_REPLICAS = int(os.getenv("BOT_REPLICAS", "1"))
+MULTIPLE_REPLICAS = BOT_REPLICAS > 1
+USE_REMINDER_CLAIMS = BOT_ROLE != 'all' or REMINDER_SHARDS > 1 or MULTIPLE_REPLICAS
+# Захваченное напоминание отправляется только в первые 4/5 аренды: остаток - запас на подтверждение в базе.
+# Не успевшее уйти напоминание не отправляется, его снова захватят после окончания аренды
+REMINDER_SEND_WINDOW = REMINDER_LEASE.total_seconds() * 0.8
+# Лимит Telegram общий для токена бота: процессы отправки делят его поровну между частями и их копиями
+REMINDER_SEND_RATE = TELEGRAM_GLOBAL_RATE / (REMINDER_SHARDS * BOT_REPLICAS)
+
+# Размер страницы при выводе заметок и напоминаний и длина текста в списке
+PAGE_SIZE = int(os.getenv("PAGE_SIZE", "10"))
+PREVIEW_LENGTH = 200
+
+# Кэш заметок и тегов: сколько всего страниц хранить в памяти и сколько секунд они актуальны.
+# Кэши сбрасываются только в своем процессе, поэтому при нескольких процессах обработки обновлений
+# они выключены (срок 0), иначе копии отдавали бы устаревшие данные после изменений в другой копии
+LOCAL_CACHES = BOT_ROLE == 'all' and not MULTIPLE_REPLICAS
+NOTES_CACHE_MAX_ITEMS = int(os.getenv("NOTES_CACHE_MAX_ITEMS", "20000"))
+NOTES_CACHE_TTL = float(os.getenv("NOTES_CACHE_TTL", "600")) if LOCAL_CACHES else 0
+
+# Выгрузка и загрузка данных (/export, /import): сколько строк читать и записывать за раз
+# и максимальный размер загружаемого файла (Bot API отдает ботам файлы до 20 МБ)
+EXPORT_BATCH_SIZE = int(os.getenv("EXPORT_BATCH_SIZE", "1000"))
+IMPORT_BATCH_SIZE = int(os.getenv("IMPORT_BATCH_SIZE", "1000"))
+IMPORT_MAX_FILE_SIZE = 20 * 1024 * 1024
+
+# Часовой пояс по умолчанию для пользователей, которые не выбрали свой командой /timezone,
+# и кэш настроек пользователей (сколько пользователей хранить и сколько секунд)
+DEFAULT_TIMEZONE_NAME = os.getenv("DEFAULT_TIMEZONE", "Europe/Moscow")
+DEFAULT_TIMEZONE = ZoneInfo(DEFAULT_TIMEZONE_NAME)
+SETTINGS_CACHE_MAX_ITEMS = int(os.getenv("SETTINGS_CACHE_MAX_ITEMS", "50000"))
+SETTINGS_CACHE_TTL = float(os.getenv("SETTINGS_CACHE_TTL", "300")) if LOCAL_CACHES else 0
+
+# Метрики в формате Prometheus на http://METRICS_LISTEN:METRICS_PORT/metrics (0 - метрики выключены)
+METRICS_PORT = int(os.getenv("METRICS_PORT", "0"))
+METRICS_LISTEN = os.getenv("METRICS_LISTEN", "127.0.0.1")
+
+
+class PoolTimeoutError(Exception):
+    pass
+
+
+# Пул соединений: не больше max_size соединений, ожидание свободного с таймаутом и статистика загрузки
+class DatabasePool:
+    def __init__(self, dsn, min_size, max_size, timeout):
+        self._pool = pg_pool.ThreadedConnectionPool(min_size, max_size, dsn)
+        self._slots = threading.BoundedSemaphore(max_size)
+        self._lock = threading.Lock()
+        self.min_size = min_size
+        self.max_size = max_size
+        self.timeout = timeout
+        self.in_use = 0
+        self.peak_in_use = 0
+        self.acquired_total = 0
+        self.waited_total = 0
+        self.timeouts_total = 0
+        self.wait_seconds_total = 0.0
+
+    def _acquire_slot(self):
+        if self._slots.acquire(blocking=False):
+            return 0.0
+        # Все соединения заняты - ждем освобождения, но не дольше timeout
+        started = time.monotonic()
+        with self._lock:
+            self.waited_total += 1
+        if not self._slots.acquire(timeout=self.timeout):
+            with self._lock:
+                self.timeouts_total += 1
+            raise PoolTimeoutError(f"Нет свободных соединений с базой данных за {self.timeout} с")
+        return time.monotonic() - started
+
+    @contextmanager
+    def connection(self):
+        waited = self._acquire_slot()
+        try:
+            conn = self._pool.getconn()
+        except Exception:
+            self._slots.release()
+            raise
+        with self._lock:
+            self.in_use += 1
+            self.peak_in_use = max(self.peak_in_use, self.in_use)
+            self.acquired_total += 1
+            self.wait_seconds_total += waited
+        broken = False
+        try:
+            # Контекст соединения фиксирует транзакцию или откатывает ее при ошибке
+            with conn:
+                yield conn
+        except (psycopg2.InterfaceError, psycopg2.OperationalError):
+            broken = True
+            raise
+        finally:
+            self._pool.putconn(conn, close=broken or bool(conn.closed))
+            with self._lock:
+                self.in_use -= 1
+            self._slots.release()
+
+    def stats(self):
+        with self._lock:
+            return {
+                'min_size': self.min_size,
+                'max_size': self.max_size,
+                'in_use': self.in_use,
+                'peak_in_use': self.peak_in_use,
+                'saturation': self.in_use / self.max_size,
+                'acquired_total': self.acquired_total,
+                'waited_total': self.waited_total,
+                'timeouts_total': self.timeouts_total,
+                'wait_seconds_total': round(self.wait_seconds_total, 3),
+            }
+
+    def close(self):
+        self._pool.closeall()
+
+
+_db_pool = None
+_db_pool_lock = threading.Lock()
+
+# Пул создается один раз при первом обращении и общий для всех функций работы с базой
+def get_db_pool():
+    global _db_pool
+    if _db_pool is None:
+        with _db_pool_lock:
+            if _db_pool is None:
+                _db_pool = DatabasePool(os.getenv("DATABASE_URL"), DB_POOL_MIN_SIZE, DB_POOL_MAX_SIZE, DB_POOL_TIMEOUT)
+    return _db_pool
+
+def close_db_pool():
+    global _db_pool
+    with _db_pool_lock:
+        if _db_pool is not None:
+            _db_pool.close()
+            _db_pool = None
+
+# Функция для подключения к базе данных (соединение берется из пула и возвращается в него после with)
 def get_db_connection():
-    return psycopg2.connect(os.getenv("DATABASE_URL"))
+    return get_db_pool().connection()
+
+# Блокирующие запросы выполняются в отдельных потоках, чтобы не останавливать цикл событий бота
+_db_executor = ThreadPoolExecutor(max_workers=DB_POOL_MAX_SIZE, thread_name_prefix="db")
+
+async def run_db(func, *args, **kwargs):
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(_db_executor, partial(func, *args, **kwargs))
 
 def drop_tables():
-    conn = get_db_connection()
-    c = conn.cursor()
-    c.execute("DROP TABLE IF EXISTS notes")
-    c.execute("DROP TABLE IF EXISTS reminders")
-    conn.commit()
-    conn.close()
+    get_storage().drop_tables()
 
 # Настройка логирования
 logging.basicConfig(
@@ -31,106 +244,1848 @@ ACTION_ADD_NOTE = 'add_note'
 ACTION_ADD_REMINDER = 'add_reminder'
 ACTION_EDIT_NOTE = 'edit_note'
 ACTION_EDIT_REMINDER = 'edit_reminder'
+ACTION_SEARCH_NOTES = 'search_notes'
+ACTION_IMPORT = 'import'
 
-# Инициализация базы данных
-def init_db():
-    with get_db_connection() as conn:
+# Миграции схемы базы данных.
+# Каждая миграция - функция, получающая соединение; примененные версии записываются в schema_migrations.
+MIGRATION_LOCK_ID = 742001
+MIGRATION_LOCK_POLL_INTERVAL = 1
+MIGRATION_BATCH_SIZE = 5000
+
+# Выполнение запросов в отдельной транзакции
+def run_statements(conn, *statements):
+    with conn.cursor() as c:
+        for statement in statements:
+            c.execute(statement)
+    conn.commit()
+
+# CREATE INDEX CONCURRENTLY нельзя выполнять внутри транзакции, зато он не блокирует запись в таблицу.
+# Открытая транзакция (например, после проверочного SELECT) сначала завершается
+def run_concurrently(conn, *statements):
+    conn.commit()
+    conn.autocommit = True
+    try:
         with conn.cursor() as c:
-            c.execute('''
-                CREATE TABLE IF NOT EXISTS notes (
-                    user_id BIGINT,
-                    tag TEXT,
-                    note TEXT
-                )
-            ''')
-            c.execute('''
-                CREATE TABLE IF NOT EXISTS reminders (
-                    user_id BIGINT,
-                    reminder_time TIMESTAMP,
-                    reminder_text TEXT
+            for statement in statements:
+                c.execute(statement)
+    finally:
+        conn.autocommit = False
+
+# Прерванный CREATE INDEX CONCURRENTLY оставляет недействительный индекс, который IF NOT EXISTS
+# при повторе считает готовым. Такие индексы таблиц бота удаляются перед применением миграций
+def drop_invalid_indexes(conn):
+    with conn.cursor() as c:
+        c.execute('''
+            SELECT index_class.relname
+            FROM pg_index
+            JOIN pg_class index_class ON index_class.oid = pg_index.indexrelid
+            JOIN pg_class table_class ON table_class.oid = pg_index.indrelid
+            WHERE NOT pg_index.indisvalid AND table_class.relname IN ('notes', 'reminders')
+              AND pg_table_is_visible(table_class.oid)
+        ''')
+        invalid = [row[0] for row in c.fetchall()]
+    for index in invalid:
+        logger.warning(f"Удаление недействительного индекса {index}, оставшегося от прерванной миграции")
+        run_concurrently(conn, sql.SQL("DROP INDEX CONCURRENTLY IF EXISTS {}").format(sql.Identifier(index)))
+
+# Добавление суррогатного первичного ключа id без долгой блокировки таблицы:
+# столбец и последовательность добавляются мгновенно, старые строки нумеруются пачками,
+# уникальный индекс строится конкурентно и затем становится первичным ключом.
+# NOT NULL, который требует первичный ключ, подтверждается CHECK-ограничением NOT VALID + VALIDATE
+# (проверка без блокировки записи), тогда SET NOT NULL не сканирует таблицу под эксклюзивной блокировкой
+def add_surrogate_key(conn, table):
+    table_id = sql.Identifier(table)
+    sequence = sql.Identifier(f"{table}_id_seq")
+    index = sql.Identifier(f"{table}_id_idx")
+    constraint = f"{table}_pkey"
+    not_null = sql.Identifier(f"{table}_id_not_null")
+    run_statements(
+        conn,
+        sql.SQL("ALTER TABLE {} ADD COLUMN IF NOT EXISTS id BIGINT").format(table_id),
+        sql.SQL("CREATE SEQUENCE IF NOT EXISTS {} OWNED BY {}.id").format(sequence, table_id),
+        sql.SQL("ALTER TABLE {} ALTER COLUMN id SET DEFAULT nextval({})").format(table_id, sql.Literal(f"{table}_id_seq")),
+    )
+    while True:
+        with conn.cursor() as c:
+            c.execute(sql.SQL(
+                "UPDATE {table} SET id = nextval({seq}) "
+                "WHERE ctid IN (SELECT ctid FROM {table} WHERE id IS NULL LIMIT %s)"
+            ).format(table=table_id, seq=sql.Literal(f"{table}_id_seq")), (MIGRATION_BATCH_SIZE,))
+            updated = c.rowcount
+        conn.commit()
+        if updated == 0:
+            break
+    run_concurrently(conn, sql.SQL("CREATE UNIQUE INDEX CONCURRENTLY IF NOT EXISTS {} ON {} (id)").format(index, table_id))
+    with conn.cursor() as c:
+        c.execute("SELECT conname FROM pg_constraint WHERE conname IN (%s, %s)", (constraint, f"{table}_id_not_null"))
+        constraints = {row[0] for row in c.fetchall()}
+    conn.commit()
+    if constraint in constraints:
+        return
+    if f"{table}_id_not_null" not in constraints:
+        run_statements(conn, sql.SQL("ALTER TABLE {} ADD CONSTRAINT {} CHECK (id IS NOT NULL) NOT VALID").format(table_id, not_null))
+    run_statements(conn, sql.SQL("ALTER TABLE {} VALIDATE CONSTRAINT {}").format(table_id, not_null))
+    run_statements(
+        conn,
+        sql.SQL("ALTER TABLE {} ALTER COLUMN id SET NOT NULL").format(table_id),
+        sql.SQL("ALTER TABLE {} ADD CONSTRAINT {} PRIMARY KEY USING INDEX {}").format(table_id, sql.Identifier(constraint), index),
+        sql.SQL("ALTER TABLE {} DROP CONSTRAINT {}").format(table_id, not_null),
+    )
+
+# Версия 1: исходные таблицы
+def migration_initial_schema(conn):
+    run_statements(
+        conn,
+        '''
+            CREATE TABLE IF NOT EXISTS notes (
+                user_id BIGINT,
+                tag TEXT,
+                note TEXT
+            )
+        ''',
+        '''
+            CREATE TABLE IF NOT EXISTS reminders (
+                user_id BIGINT,
+                reminder_time TIMESTAMP,
+                reminder_text TEXT
+            )
+        ''',
+    )
+
+# Версия 2: первичные ключи и индексы для поиска заметок и выборки напоминаний по времени
+def migration_keys_and_indexes(conn):
+    add_surrogate_key(conn, 'notes')
+    add_surrogate_key(conn, 'reminders')
+    run_concurrently(
+        conn,
+        "CREATE INDEX CONCURRENTLY IF NOT EXISTS notes_user_id_tag_idx ON notes (user_id, tag)",
+        "CREATE INDEX CONCURRENTLY IF NOT EXISTS reminders_reminder_time_idx ON reminders (reminder_time)",
+        "CREATE INDEX CONCURRENTLY IF NOT EXISTS reminders_user_id_reminder_time_idx ON reminders (user_id, reminder_time)",
+    )
+
+# Версия 3: индексы под постраничную выборку по ключу (id для заметок, время и id для напоминаний)
+def migration_keyset_indexes(conn):
+    run_concurrently(
+        conn,
+        "CREATE INDEX CONCURRENTLY IF NOT EXISTS notes_user_id_id_idx ON notes (user_id, id)",
+        "CREATE INDEX CONCURRENTLY IF NOT EXISTS notes_user_id_tag_id_idx ON notes (user_id, tag, id)",
+        "CREATE INDEX CONCURRENTLY IF NOT EXISTS reminders_user_id_reminder_time_id_idx ON reminders (user_id, reminder_time, id)",
+        "DROP INDEX CONCURRENTLY IF EXISTS notes_user_id_tag_idx",
+        "DROP INDEX CONCURRENTLY IF EXISTS reminders_user_id_reminder_time_idx",
+    )
+
+# Версия 4: состояние диалогов пользователей (user_data) в JSON
+def migration_user_state(conn):
+    run_statements(conn, '''
+        CREATE TABLE IF NOT EXISTS user_state (
+            user_id BIGINT PRIMARY KEY,
+            data TEXT NOT NULL,
+            updated_at TIMESTAMP
+        )
+    ''')
+
+# Документ для полнотекстового поиска по заметке (русская морфология). Запрос поиска использует то же
+# выражение, иначе индекс не подойдет
+NOTES_DOCUMENT = "to_tsvector('russian', coalesce(tag, '') || ' ' || coalesce(note, ''))"
+
+# Версия 5: полнотекстовый индекс по заметкам и триграммный индекс по тегам для нечеткого поиска.
+# Индекс по выражению строится конкурентно и, в отличие от вычисляемого столбца, не переписывает таблицу
+# Без прав на создание расширения pg_trgm (частый случай в управляемых базах) поиск работает только по словам
+def migration_search_indexes(conn):
+    try:
+        run_statements(conn, "CREATE EXTENSION IF NOT EXISTS pg_trgm")
+        trigram = True
+    except psycopg2.Error as e:
+        conn.rollback()
+        logger.warning(f"Расширение pg_trgm недоступно, поиск похожих тегов выключен "
+                       f"(его можно установить позже, тогда перезапустите бота): {e}")
+        trigram = False
+    run_concurrently(conn, f"CREATE INDEX CONCURRENTLY IF NOT EXISTS notes_document_idx ON notes USING GIN ({NOTES_DOCUMENT})")
+    if trigram:
+        run_concurrently(conn, "CREATE INDEX CONCURRENTLY IF NOT EXISTS notes_tag_trgm_idx ON notes USING GIN (tag gin_trgm_ops)")
+
+# Версия 6: правило повторения напоминания (RRULE); reminder_time хранит ближайшее срабатывание
+def migration_reminder_recurrence(conn):
+    run_statements(conn, "ALTER TABLE reminders ADD COLUMN IF NOT EXISTS recurrence TEXT")
+
+# Версия 7: настройки пользователей (часовой пояс)
+def migration_user_settings(conn):
+    run_statements(conn, '''
+        CREATE TABLE IF NOT EXISTS user_settings (
+            user_id BIGINT PRIMARY KEY,
+            timezone TEXT NOT NULL
+        )
+    ''')
+
+# Версия 8: аренда напоминания процессом отправки (режим нескольких процессов)
+def migration_reminder_claims(conn):
+    run_statements(conn, "ALTER TABLE reminders ADD COLUMN IF NOT EXISTS claimed_until TIMESTAMP")
+
+MIGRATIONS = [
+    (1, "Начальная схема", migration_initial_schema),
+    (2, "Первичные ключи и индексы", migration_keys_and_indexes),
+    (3, "Индексы для постраничного вывода", migration_keyset_indexes),
+    (4, "Состояние диалогов пользователей", migration_user_state),
+    (5, "Индексы для поиска заметок", migration_search_indexes),
+    (6, "Повторяющиеся напоминания", migration_reminder_recurrence),
+    (7, "Настройки пользователей", migration_user_settings),
+    (8, "Аренда напоминаний", migration_reminder_claims),
+]
+
+# Применение недостающих миграций. Advisory lock не дает нескольким копиям бота мигрировать одновременно
+# Блокировка миграций берется опросом pg_try_advisory_lock: ожидание в pg_advisory_lock держало бы снимок,
+# и CREATE INDEX CONCURRENTLY в процессе, который применяет миграции, ждал бы его - взаимная блокировка
+def acquire_migration_lock(conn):
+    waiting = False
+    while True:
+        with conn.cursor() as c:
+            c.execute("SELECT pg_try_advisory_lock(%s)", (MIGRATION_LOCK_ID,))
+            locked = c.fetchone()[0]
+        conn.commit()
+        if locked:
+            return
+        if not waiting:
+            logger.info("Миграции применяет другой процесс, ожидание")
+            waiting = True
+        time.sleep(MIGRATION_LOCK_POLL_INTERVAL)
+
+def migrate_db():
+    with get_db_connection() as conn:
+        acquire_migration_lock(conn)
+        try:
+            run_statements(conn, '''
+                CREATE TABLE IF NOT EXISTS schema_migrations (
+                    version INTEGER PRIMARY KEY,
+                    description TEXT,
+                    applied_at TIMESTAMP DEFAULT (now() AT TIME ZONE 'utc')
                 )
             ''')
+            with conn.cursor() as c:
+                c.execute("SELECT version FROM schema_migrations")
+                applied = {row[0] for row in c.fetchall()}
             conn.commit()
+            if any(version not in applied for version, _, _ in MIGRATIONS):
+                drop_invalid_indexes(conn)
+            for version, description, migration in MIGRATIONS:
+                if version in applied:
+                    continue
+                logger.info(f"Применение миграции {version}: {description}")
+                migration(conn)
+                with conn.cursor() as c:
+                    c.execute("INSERT INTO schema_migrations (version, description) VALUES (%s, %s)", (version, description))
+                conn.commit()
+        finally:
+            conn.rollback()
+            run_statements(conn, f"SELECT pg_advisory_unlock({MIGRATION_LOCK_ID})")
 
-# Добавление заметки
-def add_note(user_id, tag, note):
-    with get_db_connection() as conn:
-        with conn.cursor() as c:
-            c.execute("INSERT INTO notes (user_id, tag, note) VALUES (%s, %s, %s)", (user_id, tag, note))
+# Миграции SQLite (своя нумерация версий, схема соответствует последней версии PostgreSQL)
+def sqlite_table_columns(conn, table):
+    return [row[1] for row in conn.execute(f"PRAGMA table_info({table})")]
+
+# Версия 1: таблицы с первичными ключами. Таблицы старой версии бота (organizer1.db) без id
+# пересоздаются с сохранением данных
+def sqlite_migration_initial_schema(conn):
+    tables = (
+        ('notes', "user_id INTEGER, tag TEXT, note TEXT", "user_id, tag, note"),
+        ('reminders', "user_id INTEGER, reminder_time TIMESTAMP, reminder_text TEXT", "user_id, reminder_time, reminder_text"),
+    )
+    for table, definition, columns in tables:
+        existing = sqlite_table_columns(conn, table)
+        if 'id' in existing:
+            continue
+        conn.execute(f"CREATE TABLE {table}_new (id INTEGER PRIMARY KEY, {definition})")
+        if existing:
+            conn.execute(f"INSERT INTO {table}_new ({columns}) SELECT {columns} FROM {table}")
+            conn.execute(f"DROP TABLE {table}")
+        conn.execute(f"ALTER TABLE {table}_new RENAME TO {table}")
+
+# Версия 2: индексы
+def sqlite_migration_indexes(conn):
+    conn.execute("CREATE INDEX IF NOT EXISTS notes_user_id_id_idx ON notes (user_id, id)")
+    conn.execute("CREATE INDEX IF NOT EXISTS notes_user_id_tag_id_idx ON notes (user_id, tag, id)")
+    conn.execute("CREATE INDEX IF NOT EXISTS reminders_reminder_time_idx ON reminders (reminder_time)")
+    conn.execute("CREATE INDEX IF NOT EXISTS reminders_user_id_reminder_time_id_idx ON reminders (user_id, reminder_time, id)")
+
+# Версия 3: состояние диалогов пользователей (user_data) в JSON
+def sqlite_migration_user_state(conn):
+    conn.execute("CREATE TABLE IF NOT EXISTS user_state (user_id INTEGER PRIMARY KEY, data TEXT NOT NULL, updated_at TIMESTAMP)")
+
+# Версия 4: полнотекстовый индекс FTS5 по заметкам, синхронизируется с таблицей триггерами.
+# Если SQLite собран без FTS5, поиск работает через LIKE
+def sqlite_migration_search_index(conn):
+    try:
+        conn.execute("CREATE VIRTUAL TABLE IF NOT EXISTS notes_fts USING fts5(tag, note, content='notes', content_rowid='id')")
+    except sqlite3.OperationalError as e:
+        logger.warning(f"FTS5 недоступен, поиск заметок будет работать без индекса: {e}")
+        return
+    conn.execute('''
+        CREATE TRIGGER IF NOT EXISTS notes_fts_insert AFTER INSERT ON notes BEGIN
+            INSERT INTO notes_fts (rowid, tag, note) VALUES (new.id, new.tag, new.note);
+        END
+    ''')
+    conn.execute('''
+        CREATE TRIGGER IF NOT EXISTS notes_fts_delete AFTER DELETE ON notes BEGIN
+            INSERT INTO notes_fts (notes_fts, rowid, tag, note) VALUES ('delete', old.id, old.tag, old.note);
+        END
+    ''')
+    conn.execute('''
+        CREATE TRIGGER IF NOT EXISTS notes_fts_update AFTER UPDATE ON notes BEGIN
+            INSERT INTO notes_fts (notes_fts, rowid, tag, note) VALUES ('delete', old.id, old.tag, old.note);
+            INSERT INTO notes_fts (rowid, tag, note) VALUES (new.id, new.tag, new.note);
+        END
+    ''')
+    conn.execute("INSERT INTO notes_fts (notes_fts) VALUES ('rebuild')")
+
+# Версия 5: правило повторения напоминания (RRULE)
+def sqlite_migration_reminder_recurrence(conn):
+    if 'recurrence' not in sqlite_table_columns(conn, 'reminders'):
+        conn.execute("ALTER TABLE reminders ADD COLUMN recurrence TEXT")
+
+# Версия 6: настройки пользователей (часовой пояс)
+def sqlite_migration_user_settings(conn):
+    conn.execute("CREATE TABLE IF NOT EXISTS user_settings (user_id INTEGER PRIMARY KEY, timezone TEXT NOT NULL)")
+
+# Версия 7: аренда напоминания (столбец для совместимости схем, SQLite работает в одном процессе)
+def sqlite_migration_reminder_claims(conn):
+    if 'claimed_until' not in sqlite_table_columns(conn, 'reminders'):
+        conn.execute("ALTER TABLE reminders ADD COLUMN claimed_until TIMESTAMP")
+
+SQLITE_MIGRATIONS = [
+    (1, "Начальная схема", sqlite_migration_initial_schema),
+    (2, "Индексы", sqlite_migration_indexes),
+    (3, "Состояние диалогов пользователей", sqlite_migration_user_state),
+    (4, "Полнотекстовый индекс заметок", sqlite_migration_search_index),
+    (5, "Повторяющиеся напоминания", sqlite_migration_reminder_recurrence),
+    (6, "Настройки пользователей", sqlite_migration_user_settings),
+    (7, "Аренда напоминаний", sqlite_migration_reminder_claims),
+]
+
+# Каждая миграция SQLite выполняется в одной транзакции вместе с записью в schema_migrations
+def migrate_sqlite(conn):
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS schema_migrations (
+            version INTEGER PRIMARY KEY,
+            description TEXT,
+            applied_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+    applied = {row[0] for row in conn.execute("SELECT version FROM schema_migrations")}
+    for version, description, migration in SQLITE_MIGRATIONS:
+        if version in applied:
+            continue
+        logger.info(f"Применение миграции SQLite {version}: {description}")
+        with conn:
+            conn.execute("BEGIN IMMEDIATE")
+            migration(conn)
+            conn.execute("INSERT INTO schema_migrations (version, description) VALUES (?, ?)", (version, description))
+
+# Время в SQLite хранится текстом ISO 8601 в UTC без пояса - так строки сравниваются и сортируются как время
+sqlite3.register_adapter(datetime, lambda moment: as_utc(moment).replace(tzinfo=None).isoformat())
+sqlite3.register_converter("TIMESTAMP", lambda value: as_utc(datetime.fromisoformat(value.decode())).replace(tzinfo=None))
+
+
+# Хранилище заметок и напоминаний. Запросы общие для всех СУБД (плейсхолдеры %s),
+# реализации отличаются способом выполнения и несколькими специфичными конструкциями
+class Storage:
+    name = None
+
+    def migrate(self):
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+    def stats(self):
+        return {'backend': self.name}
+
+    def _fetchall(self, query, params=()):
+        raise NotImplementedError
+
+    def _fetchone(self, query, params=()):
+        rows = self._fetchall(query, params)
+        return rows[0] if rows else None
+
+    # Изменение данных, возвращает число затронутых строк
+    def _execute(self, query, params=()):
+        raise NotImplementedError
+
+    # Один запрос для каждого набора параметров в одной транзакции
+    def _execute_many(self, query, params_list):
+        raise NotImplementedError
+
+    # Вставка строки, возвращает ее id
+    def _insert(self, query, params):
+        raise NotImplementedError
+
+    # Чтение большого результата пачками по batch_size строк, без загрузки его в память целиком
+    def _iterate(self, query, params, batch_size):
+        raise NotImplementedError
+
+    # Удаление строки пользователя по id, возвращает значение столбца column удаленной строки или None
+    def _delete_returning(self, table, column, row_id, user_id):
+        raise NotImplementedError
+
+    # Условие "column входит в список ids" и его параметры
+    def _in_ids(self, column, ids):
+        raise NotImplementedError
+
+    def drop_tables(self):
+        self._execute("DROP TABLE IF EXISTS notes")
+        self._execute("DROP TABLE IF EXISTS reminders")
+
+    def add_note(self, user_id, tag, note):
+        return self._insert("INSERT INTO notes (user_id, tag, note) VALUES (%s, %s, %s)", (user_id, tag, note))
+
+    def get_note(self, user_id, note_id):
+        return self._fetchone("SELECT id, tag, note FROM notes WHERE id=%s AND user_id=%s", (note_id, user_id))
+
+    def find_notes(self, user_id, tag=None, after_id=None, before_id=None, limit=PAGE_SIZE, tag_note_id=None):
+        conditions = ["user_id=%s"]
+        params = [user_id]
+        if tag:
+            conditions.append("tag=%s")
+            params.append(tag)
+        if tag_note_id:
+            conditions.append("tag=(SELECT tag FROM notes WHERE id=%s AND user_id=%s)")
+            params.extend([tag_note_id, user_id])
+        if after_id is not None:
+            conditions.append("id > %s")
+            params.append(after_id)
+        if before_id is not None:
+            conditions.append("id < %s")
+            params.append(before_id)
+        order = "DESC" if before_id is not None else "ASC"
+        params.append(limit + 1)
+        notes = self._fetchall(f"SELECT id, tag, note FROM notes WHERE {' AND '.join(conditions)} ORDER BY id {order} LIMIT %s", params)
+        has_more = len(notes) > limit
+        notes = notes[:limit]
+        if before_id is not None:
+            notes.reverse()
+        return tuple(notes), has_more
+
+    # Поиск заметок по тексту: строки (id, tag, note) по убыванию релевантности и признак следующей страницы
+    def search_notes(self, user_id, query, offset=0, limit=PAGE_SIZE):
+        raise NotImplementedError
+
+    def get_all_tags(self, user_id):
+        return tuple(self._fetchall("SELECT tag, MIN(id) FROM notes WHERE user_id=%s GROUP BY tag ORDER BY tag", (user_id,)))
+
+    def update_note(self, user_id, note_id, note):
+        return self._execute("UPDATE notes SET note=%s WHERE id=%s AND user_id=%s", (note, note_id, user_id)) > 0
+
+    def delete_note(self, user_id, note_id):
+        return self._delete_returning('notes', 'note', note_id, user_id)
+
+    def add_reminder(self, user_id, reminder_time, reminder_text, recurrence=None):
+        return self._insert("INSERT INTO reminders (user_id, reminder_time, reminder_text, recurrence) VALUES (%s, %s, %s, %s)",
+                            (user_id, reminder_time, reminder_text, recurrence))
+
+    def get_reminder(self, user_id, reminder_id):
+        return self._fetchone("SELECT id, reminder_time, reminder_text FROM reminders WHERE id=%s AND user_id=%s",
+                              (reminder_id, user_id))
+
+    def update_reminder(self, user_id, reminder_id, reminder_time, reminder_text, recurrence=None):
+        return self._execute("UPDATE reminders SET reminder_time=%s, reminder_text=%s, recurrence=%s, claimed_until=NULL "
+                             "WHERE id=%s AND user_id=%s",
+                             (reminder_time, reminder_text, recurrence, reminder_id, user_id)) > 0
+
+    def delete_reminder(self, user_id, reminder_id):
+        return self._delete_returning('reminders', 'reminder_text', reminder_id, user_id)
+
+    # Удаление отправленных разовых напоминаний: пары (id, отправленное reminder_time).
+    # Напоминание, которое пользователь успел изменить после отправки, не удаляется
+    def delete_delivered_reminders(self, delivered):
+        self._execute_many("DELETE FROM reminders WHERE id=%s AND reminder_time=%s", delivered)
+
+    # Перенос повторяющихся напоминаний на следующее срабатывание: тройки (новое reminder_time, id, отправленное reminder_time).
+    # Измененные пользователем напоминания не переносятся
+    def reschedule_reminders(self, schedule):
+        self._execute_many("UPDATE reminders SET reminder_time=%s, claimed_until=NULL WHERE id=%s AND reminder_time=%s", schedule)
+
+    def find_reminders(self, user_id, start=None, end=None, after=None, before=None, limit=PAGE_SIZE):
+        conditions = ["user_id=%s"]
+        params = [user_id]
+        if start is not None:
+            conditions.append("reminder_time >= %s")
+            params.append(start)
+        if end is not None:
+            conditions.append("reminder_time < %s")
+            params.append(end)
+        if after is not None:
+            conditions.append("(reminder_time, id) > (%s, %s)")
+            params.extend(after)
+        if before is not None:
+            conditions.append("(reminder_time, id) < (%s, %s)")
+            params.extend(before)
+        order = "DESC" if before is not None else "ASC"
+        params.append(limit + 1)
+        reminders = self._fetchall(f"SELECT id, reminder_time, reminder_text, recurrence FROM reminders WHERE {' AND '.join(conditions)} "
+                                   f"ORDER BY reminder_time {order}, id {order} LIMIT %s", params)
+        has_more = len(reminders) > limit
+        reminders = reminders[:limit]
+        if before is not None:
+            reminders.reverse()
+        return reminders, has_more
+
+    def get_pending_reminders(self):
+        return self._fetchall("SELECT id, user_id, reminder_time, reminder_text, recurrence FROM reminders")
+
+    # Все заметки и напоминания пользователя для выгрузки
+    def iter_notes(self, user_id, batch_size):
+        return self._iterate("SELECT tag, note FROM notes WHERE user_id=%s ORDER BY id", (user_id,), batch_size)
+
+    def iter_reminders(self, user_id, batch_size):
+        return self._iterate("SELECT reminder_time, reminder_text, recurrence FROM reminders WHERE user_id=%s "
+                             "ORDER BY reminder_time, id", (user_id,), batch_size)
+
+    # Пакетная вставка заметок: строки (user_id, tag, note)
+    def add_notes(self, rows):
+        self._execute_many("INSERT INTO notes (user_id, tag, note) VALUES (%s, %s, %s)", rows)
+
+    # Захват наступивших напоминаний своей части для отправки (только для режима нескольких процессов)
+    def claim_reminders(self, shard, shards, now, lease_until, limit):
+        raise NotImplementedError(f"Хранилище {self.name} не поддерживает несколько процессов отправки")
+
+    # Пакетная вставка напоминаний: строки (user_id, reminder_time, reminder_text, recurrence).
+    # Возвращает строки (id, user_id, reminder_time, reminder_text, recurrence) для планировщика
+    def add_reminders(self, rows):
+        raise NotImplementedError
+
+    def delete_user_data(self, user_ids):
+        condition, params = self._in_ids('user_id', user_ids)
+        self._execute(f"DELETE FROM notes WHERE {condition}", params)
+        self._execute(f"DELETE FROM reminders WHERE {condition}", params)
+        self._execute(f"DELETE FROM user_state WHERE {condition}", params)
+        self._execute(f"DELETE FROM user_settings WHERE {condition}", params)
+
+    # Часовой пояс пользователя (имя из базы IANA) или None, если пользователь его не выбирал
+    def get_user_timezone(self, user_id):
+        row = self._fetchone("SELECT timezone FROM user_settings WHERE user_id=%s", (user_id,))
+        return row[0] if row else None
+
+    def set_user_timezone(self, user_id, timezone_name):
+        self._execute("INSERT INTO user_settings (user_id, timezone) VALUES (%s, %s) "
+                      "ON CONFLICT (user_id) DO UPDATE SET timezone = excluded.timezone", (user_id, timezone_name))
+
+    # Состояние диалогов: строки (user_id, data) всех пользователей или только перечисленных
+    def get_user_states(self, user_ids=None):
+        if user_ids is None:
+            return self._fetchall("SELECT user_id, data FROM user_state")
+        condition, params = self._in_ids('user_id', user_ids)
+        return self._fetchall(f"SELECT user_id, data FROM user_state WHERE {condition}", params)
+
+    # Запись состояний пачкой: states - словарь user_id -> JSON
+    def save_user_states(self, states):
+        updated_at = datetime.now(timezone.utc).replace(tzinfo=None)
+        self._execute_many(
+            "INSERT INTO user_state (user_id, data, updated_at) VALUES (%s, %s, %s) "
+            "ON CONFLICT (user_id) DO UPDATE SET data = excluded.data, updated_at = excluded.updated_at",
+            [(user_id, data, updated_at) for user_id, data in states.items()])
+
+    def delete_user_states(self, user_ids):
+        condition, params = self._in_ids('user_id', user_ids)
+        self._execute(f"DELETE FROM user_state WHERE {condition}", params)
+
+
+# PostgreSQL: соединения из общего пула
+class PostgresStorage(Storage):
+    name = 'postgres'
+
+    def __init__(self):
+        self._trigram = None
+
+    def migrate(self):
+        migrate_db()
+
+    def close(self):
+        close_db_pool()
+
+    def stats(self):
+        return {'backend': self.name, **get_db_pool().stats()}
+
+    def _fetchall(self, query, params=()):
+        with get_db_connection() as conn:
+            with conn.cursor() as c:
+                c.execute(query, params)
+                return c.fetchall()
+
+    def _execute(self, query, params=()):
+        with get_db_connection() as conn:
+            with conn.cursor() as c:
+                c.execute(query, params)
+                rowcount = c.rowcount
             conn.commit()
+        return rowcount
 
-# Поиск заметок по тегу
-def find_notes(user_id, tag=None):
-    with get_db_connection() as conn:
-        with conn.cursor() as c:
-            if tag:
-                c.execute("SELECT note FROM notes WHERE user_id=%s AND tag=%s", (user_id, tag))
-            else:
-                c.execute("SELECT note FROM notes WHERE user_id=%s", (user_id,))
-            notes = c.fetchall()
-    return notes
+    def _execute_many(self, query, params_list):
+        with get_db_connection() as conn:
+            with conn.cursor() as c:
+                extras.execute_batch(c, query, params_list)
+            conn.commit()
 
-# Получение всех тегов заметок
-def get_all_tags(user_id):
-    with get_db_connection() as conn:
-        with conn.cursor() as c:
-            c.execute("SELECT DISTINCT tag FROM notes WHERE user_id=%s", (user_id,))
-            tags = c.fetchall()
-    return tags
+    def _insert(self, query, params):
+        with get_db_connection() as conn:
+            with conn.cursor() as c:
+                c.execute(query + " RETURNING id", params)
+                row_id = c.fetchone()[0]
+            conn.commit()
+        return row_id
 
-# Удаление заметки
-def delete_note(user_id, note_text):
-    with get_db_connection() as conn:
-        with conn.cursor() as c:
-            c.execute("DELETE FROM notes WHERE user_id=%s AND note=%s", (user_id, note_text))
+    def _delete_returning(self, table, column, row_id, user_id):
+        with get_db_connection() as conn:
+            with conn.cursor() as c:
+                c.execute(sql.SQL("DELETE FROM {} WHERE id=%s AND user_id=%s RETURNING {}").format(
+                    sql.Identifier(table), sql.Identifier(column)), (row_id, user_id))
+                row = c.fetchone()
             conn.commit()
+        return row[0] if row else None
 
-# Добавление напоминания
-def add_reminder(user_id, reminder_time, reminder_text):
-    with get_db_connection() as conn:
-        with conn.cursor() as c:
-            c.execute("INSERT INTO reminders (user_id, reminder_time, reminder_text) VALUES (%s, %s, %s)", 
-                      (user_id, reminder_time, reminder_text))
+    def _in_ids(self, column, ids):
+        return f"{column} = ANY(%s)", [list(ids)]
+
+    # Именованный курсор выполняется на сервере и передает строки пачками по itersize
+    def _iterate(self, query, params, batch_size):
+        with get_db_connection() as conn:
+            with conn.cursor(name='export') as c:
+                c.itersize = batch_size
+                c.execute(query, params)
+                yield from c
             conn.commit()
 
-# Удаление напоминания
-def delete_reminder(user_id, reminder_text):
-    with get_db_connection() as conn:
-        with conn.cursor() as c:
-            c.execute("DELETE FROM reminders WHERE user_id=%s AND reminder_text=%s", (user_id, reminder_text))
+    # Пачка строк вставляется одним многострочным INSERT
+    def add_notes(self, rows):
+        with get_db_connection() as conn:
+            with conn.cursor() as c:
+                extras.execute_values(c, "INSERT INTO notes (user_id, tag, note) VALUES %s", rows, page_size=len(rows))
             conn.commit()
 
-# Получение напоминаний на определенную дату
-def get_reminders_by_date(user_id, date):
-    with get_db_connection() as conn:
-        with conn.cursor() as c:
-            c.execute("SELECT reminder_time, reminder_text FROM reminders WHERE user_id=%s AND DATE(reminder_time)=%s ORDER BY reminder_time", 
-                      (user_id, date))
-            reminders = c.fetchall()
-    return reminders
+    def add_reminders(self, rows):
+        with get_db_connection() as conn:
+            with conn.cursor() as c:
+                added = extras.execute_values(
+                    c, "INSERT INTO reminders (user_id, reminder_time, reminder_text, recurrence) VALUES %s "
+                       "RETURNING id, user_id, reminder_time, reminder_text, recurrence", rows, page_size=len(rows), fetch=True)
+            conn.commit()
+        return added
+
+    # Напоминания части shard (user_id по модулю shards), время которых наступило, получают аренду до lease_until.
+    # SKIP LOCKED не дает двум процессам взять одну строку, а истекшая аренда (процесс упал или не смог отправить)
+    # позволяет взять напоминание снова. Выборка идет по индексу reminder_time
+    def claim_reminders(self, shard, shards, now, lease_until, limit):
+        with get_db_connection() as conn:
+            with conn.cursor() as c:
+                c.execute(
+                    "UPDATE reminders SET claimed_until=%s WHERE id IN ("
+                    "SELECT id FROM reminders WHERE reminder_time <= %s AND (claimed_until IS NULL OR claimed_until < %s) "
+                    "AND mod(user_id, %s) = %s ORDER BY reminder_time LIMIT %s FOR UPDATE SKIP LOCKED) "
+                    "RETURNING id, user_id, reminder_time, reminder_text, recurrence",
+                    (lease_until, now, now, shards, shard, limit))
+                reminders = c.fetchall()
+            conn.commit()
+        return reminders
+
+    # Совпадения по словам (со стеммингом) и похожие теги (триграммы) одним запросом, с ранжированием
+    # Без расширения pg_trgm - только совпадения по словам
+    def search_notes(self, user_id, query, offset=0, limit=PAGE_SIZE):
+        if self._trigram is None:
+            self._trigram = self._fetchone("SELECT 1 FROM pg_extension WHERE extname = 'pg_trgm'") is not None
+        if self._trigram:
+            notes = self._fetchall(
+                f"SELECT id, tag, note FROM notes, websearch_to_tsquery('russian', %s) AS query "
+                f"WHERE user_id=%s AND ({NOTES_DOCUMENT} @@ query OR tag %% %s) "
+                f"ORDER BY ts_rank({NOTES_DOCUMENT}, query) + similarity(tag, %s) DESC, id DESC LIMIT %s OFFSET %s",
+                (query, user_id, query, query, limit + 1, offset))
+        else:
+            notes = self._fetchall(
+                f"SELECT id, tag, note FROM notes, websearch_to_tsquery('russian', %s) AS query "
+                f"WHERE user_id=%s AND {NOTES_DOCUMENT} @@ query "
+                f"ORDER BY ts_rank({NOTES_DOCUMENT}, query) DESC, id DESC LIMIT %s OFFSET %s",
+                (query, user_id, limit + 1, offset))
+        return tuple(notes[:limit]), len(notes) > limit
+
+
+# SQLite во встроенном режиме: WAL, отдельное соединение на каждый читающий поток,
+# все изменения выполняет один поток-писатель (SQLite допускает только одного писателя)
+class SqliteStorage(Storage):
+    name = 'sqlite'
+
+    def __init__(self, path):
+        self.path = path
+        self._local = threading.local()
+        self._connections = []
+        self._lock = threading.Lock()
+        self._writer = ThreadPoolExecutor(max_workers=1, thread_name_prefix="sqlite-writer")
+        self._fts = None
+        self.reads = 0
+        self.writes = 0
+
+    def _connection(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            # cached_statements - кэш подготовленных запросов на соединение
+            conn = sqlite3.connect(self.path, detect_types=sqlite3.PARSE_DECLTYPES, cached_statements=256,
+                                   check_same_thread=False)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute("PRAGMA busy_timeout=5000")
+            self._local.conn = conn
+            with self._lock:
+                self._connections.append(conn)
+        return conn
+
+    def _write(self, work):
+        def run():
+            conn = self._connection()
+            with conn:
+                return work(conn)
+        with self._lock:
+            self.writes += 1
+        return self._writer.submit(run).result()
+
+    def migrate(self):
+        self._writer.submit(lambda: migrate_sqlite(self._connection())).result()
+
+    def close(self):
+        self._writer.shutdown(wait=True)
+        with self._lock:
+            for conn in self._connections:
+                conn.close()
+            self._connections = []
+
+    def stats(self):
+        with self._lock:
+            return {'backend': self.name, 'connections': len(self._connections), 'reads': self.reads, 'writes': self.writes}
+
+    def _fetchall(self, query, params=()):
+        with self._lock:
+            self.reads += 1
+        return self._connection().execute(sqlite_query(query), params).fetchall()
+
+    def _execute(self, query, params=()):
+        return self._write(lambda conn: conn.execute(sqlite_query(query), params).rowcount)
+
+    def _execute_many(self, query, params_list):
+        self._write(lambda conn: conn.executemany(sqlite_query(query), params_list))
+
+    def _insert(self, query, params):
+        return self._write(lambda conn: conn.execute(sqlite_query(query), params).lastrowid)
+
+    def _iterate(self, query, params, batch_size):
+        with self._lock:
+            self.reads += 1
+        cursor = self._connection().execute(sqlite_query(query), params)
+        while True:
+            rows = cursor.fetchmany(batch_size)
+            if not rows:
+                return
+            yield from rows
+
+    # id нужны планировщику, поэтому напоминания вставляются по одному, но в одной транзакции
+    def add_reminders(self, rows):
+        query = sqlite_query("INSERT INTO reminders (user_id, reminder_time, reminder_text, recurrence) VALUES (%s, %s, %s, %s)")
+        return self._write(lambda conn: [(conn.execute(query, row).lastrowid, *row) for row in rows])
+
+    def _delete_returning(self, table, column, row_id, user_id):
+        def work(conn):
+            row = conn.execute(f"SELECT {column} FROM {table} WHERE id=? AND user_id=?", (row_id, user_id)).fetchone()
+            if row:
+                conn.execute(f"DELETE FROM {table} WHERE id=?", (row_id,))
+            return row[0] if row else None
+        return self._write(work)
+
+    def _in_ids(self, column, ids):
+        ids = list(ids)
+        return f"{column} IN ({', '.join(['%s'] * len(ids))})", ids
+
+    # FTS5 по словам запроса (каждое слово ищется как префикс) и подстрока в теге; без FTS5 - LIKE по тексту
+    def search_notes(self, user_id, query, offset=0, limit=PAGE_SIZE):
+        if self._fts is None:
+            self._fts = self._fetchone("SELECT 1 FROM sqlite_master WHERE name = 'notes_fts'") is not None
+        like = f"%{query}%"
+        words = re.findall(r'\w+', query)
+        if self._fts and words:
+            match = ' '.join(f'"{word}"*' for word in words)
+            notes = self._fetchall(
+                "SELECT notes.id, tag, note FROM notes "
+                "LEFT JOIN (SELECT rowid, bm25(notes_fts) AS score FROM notes_fts WHERE notes_fts MATCH %s) AS found "
+                "ON found.rowid = notes.id "
+                "WHERE user_id=%s AND (found.rowid IS NOT NULL OR tag LIKE %s) "
+                "ORDER BY coalesce(found.score, 0), notes.id DESC LIMIT %s OFFSET %s",
+                (match, user_id, like, limit + 1, offset))
+        else:
+            notes = self._fetchall(
+                "SELECT id, tag, note FROM notes WHERE user_id=%s AND (tag LIKE %s OR note LIKE %s) "
+                "ORDER BY id DESC LIMIT %s OFFSET %s",
+                (user_id, like, like, limit + 1, offset))
+        return tuple(notes[:limit]), len(notes) > limit
+
+
+# Запросы пишутся с плейсхолдерами %s, в SQLite используются ?
+@lru_cache(maxsize=512)
+def sqlite_query(query):
+    return query.replace('%s', '?')
+
+
+_storage = None
+_storage_lock = threading.Lock()
+
+# Хранилище выбирается переменной STORAGE_BACKEND при первом обращении
+def get_storage():
+    global _storage
+    if _storage is None:
+        with _storage_lock:
+            if _storage is None:
+                if STORAGE_BACKEND == 'sqlite':
+                    _storage = SqliteStorage(SQLITE_PATH)
+                elif STORAGE_BACKEND == 'postgres':
+                    _storage = PostgresStorage()
+                else:
+                    raise ValueError(f"Неизвестное хранилище STORAGE_BACKEND={STORAGE_BACKEND}")
+    return _storage
+
+def close_storage():
+    global _storage
+    with _storage_lock:
+        if _storage is not None:
+            _storage.close()
+            _storage = None
+
+# Инициализация базы данных
+def init_db():
+    get_storage().migrate()
+
+# Метрики: счетчики, гистограммы и показатели с метками, вывод в текстовом формате Prometheus.
+# Выключенные метрики ничего не записывают, а декораторы возвращают функцию без обертки
+class Metric:
+    type = None
+
+    def __init__(self, registry, name, help, labels=()):
+        self.enabled = registry.enabled
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def _format_labels(self, values, extra=()):
+        pairs = [*zip(self.labels, values), *extra]
+        if not pairs:
+            return ''
+        escaped = (str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for _, value in pairs)
+        return '{' + ','.join(f'{label}="{value}"' for (label, _), value in zip(pairs, escaped)) + '}'
+
+    def _samples(self):
+        with self._lock:
+            return [(self.name, self._format_labels(values), value) for values, value in self._values.items()]
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.type}"]
+        lines += [f"{name}{labels} {value}" for name, labels, value in self._samples()]
+        return '\n'.join(lines) + '\n'
+
+
+class Counter(Metric):
+    type = 'counter'
+
+    def inc(self, *labels, amount=1):
+        if not self.enabled:
+            return
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+
+class Gauge(Metric):
+    type = 'gauge'
+
+    def set(self, value, *labels):
+        if not self.enabled:
+            return
+        with self._lock:
+            self._values[labels] = value
+
+
+class Histogram(Metric):
+    type = 'histogram'
+
+    def __init__(self, registry, name, help, labels=(), buckets=(0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)):
+        super().__init__(registry, name, help, labels)
+        self.buckets = buckets
+
+    # Значение метки - [число попаданий в каждый интервал, сумма, количество]
+    def observe(self, value, *labels):
+        if not self.enabled:
+            return
+        with self._lock:
+            state = self._values.get(labels)
+            if state is None:
+                state = self._values[labels] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            state[0][bisect.bisect_left(self.buckets, value)] += 1
+            state[1] += value
+            state[2] += 1
+
+    def _samples(self):
+        with self._lock:
+            values = [(labels, list(counts), total, count) for labels, (counts, total, count) in self._values.items()]
+        samples = []
+        for labels, counts, total, count in values:
+            cumulative = 0
+            for bound, bucket_count in zip([*self.buckets, '+Inf'], counts):
+                cumulative += bucket_count
+                samples.append((f"{self.name}_bucket", self._format_labels(labels, [('le', bound)]), cumulative))
+            samples.append((f"{self.name}_sum", self._format_labels(labels), total))
+            samples.append((f"{self.name}_count", self._format_labels(labels), count))
+        return samples
+
+
+class MetricsRegistry:
+    def __init__(self, enabled):
+        self.enabled = enabled
+        self._metrics = []
+        self._collectors = []
+
+    def counter(self, name, help, labels=()):
+        return self._register(Counter(self, name, help, labels))
+
+    def gauge(self, name, help, labels=()):
+        return self._register(Gauge(self, name, help, labels))
+
+    def histogram(self, name, help, labels=(), **kwargs):
+        return self._register(Histogram(self, name, help, labels, **kwargs))
+
+    def _register(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+    # Функции, обновляющие показатели перед каждым выводом метрик
+    def collector(self, func):
+        self._collectors.append(func)
+        return func
+
+    def render(self):
+        for collect in self._collectors:
+            try:
+                collect()
+            except Exception as e:
+                logger.error(f"Ошибка при сборе метрик: {e}")
+        return ''.join(metric.render() for metric in self._metrics)
+
+
+metrics = MetricsRegistry(METRICS_PORT > 0)
+HANDLER_SECONDS = metrics.histogram("bot_handler_seconds", "Время обработки обновления", ("handler",))
+HANDLER_ERRORS = metrics.counter("bot_handler_errors_total", "Ошибки в обработчиках", ("handler",))
+CALLBACK_SECONDS = metrics.histogram("bot_callback_seconds", "Время обработки кнопки", ("route",))
+DB_SECONDS = metrics.histogram("bot_db_seconds", "Время работы функций доступа к данным", ("function",))
+DB_ERRORS = metrics.counter("bot_db_errors_total", "Ошибки функций доступа к данным", ("function",))
+TELEGRAM_ERRORS = metrics.counter("bot_telegram_errors_total", "Ошибки Bot API", ("error",))
+REMINDER_LAG_SECONDS = metrics.histogram("bot_reminder_lag_seconds", "Задержка отправки напоминания относительно его времени",
+                                         buckets=(0.1, 0.25, 0.5, 1, 2, 5, 10, 30, 60, 300))
+REMINDER_QUEUE_DEPTH = metrics.gauge("bot_reminder_queue_depth", "Напоминаний в очереди на отправку")
+REMINDER_PENDING_ACKS = metrics.gauge("bot_reminder_pending_acks", "Отправленных напоминаний, ожидающих удаления из базы")
+STORAGE_STATS = metrics.gauge("bot_storage_stat", "Статистика хранилища и пула соединений", ("stat",))
+NOTES_CACHE_STATS = metrics.gauge("bot_notes_cache_stat", "Статистика кэша заметок", ("stat",))
+
+# Замер времени обработчика обновлений; ошибки Bot API считаются по типу
+def timed_handler(func):
+    if not metrics.enabled:
+        return func
+
+    @wraps(func)
+    async def wrapper(update, context):
+        started = time.perf_counter()
+        try:
+            return await func(update, context)
+        except Exception as e:
+            HANDLER_ERRORS.inc(func.__name__)
+            if isinstance(e, TelegramError):
+                TELEGRAM_ERRORS.inc(type(e).__name__)
+            raise
+        finally:
+            HANDLER_SECONDS.observe(time.perf_counter() - started, func.__name__)
+    return wrapper
+
+# Замер времени функции доступа к данным (выполняется в потоке пула)
+def timed_db(func):
+    if not metrics.enabled:
+        return func
+
+    @wraps(func)
+    def wrapper(*args, **kwargs):
+        started = time.perf_counter()
+        try:
+            return func(*args, **kwargs)
+        except Exception:
+            DB_ERRORS.inc(func.__name__)
+            raise
+        finally:
+            DB_SECONDS.observe(time.perf_counter() - started, func.__name__)
+    return wrapper
+
+
+# Кэш результатов запросов по пользователям: LRU по пользователям с ограничением общего числа записей и TTL.
+# У каждого пользователя есть поколение: сброс кэша меняет поколение, и результат запроса,
+# начатого до изменения данных, уже не попадет в кэш
+class UserCache:
+    def __init__(self, max_items, ttl):
+        self._users = OrderedDict()
+        self._generations = itertools.count(1)
+        self._lock = threading.Lock()
+        self.max_items = max_items
+        self.ttl = ttl
+        self.items = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    # Возвращает (найдено, значение, поколение); поколение передается в store после чтения из базы.
+    # Кэш со сроком 0 выключен: каждое чтение идет в базу
+    def lookup(self, user_id, key):
+        if self.ttl <= 0:
+            self.misses += 1
+            return False, None, 0
+        with self._lock:
+            entry = self._users.get(user_id)
+            if entry is None:
+                entry = self._users[user_id] = [next(self._generations), {}]
+                self._evict()
+            else:
+                self._users.move_to_end(user_id)
+                item = entry[1].get(key)
+                if item is not None:
+                    expires_at, value = item
+                    if expires_at > time.monotonic():
+                        self.hits += 1
+                        return True, value, entry[0]
+                    del entry[1][key]
+                    self.items -= 1
+            self.misses += 1
+            return False, None, entry[0]
+
+    def store(self, user_id, key, value, generation):
+        if self.ttl <= 0:
+            return
+        with self._lock:
+            entry = self._users.get(user_id)
+            if entry is None or entry[0] != generation:
+                return
+            if key not in entry[1]:
+                self.items += 1
+            entry[1][key] = (time.monotonic() + self.ttl, value)
+            self._evict()
+
+    def invalidate(self, user_id):
+        with self._lock:
+            entry = self._users.get(user_id)
+            if entry is not None:
+                self.items -= len(entry[1])
+                entry[0] = next(self._generations)
+                entry[1] = {}
+                self.invalidations += 1
+
+    # Вытесняем давно не использовавшихся пользователей, пока не уложимся в лимит
+    def _evict(self):
+        while (self.items > self.max_items or len(self._users) > self.max_items) and self._users:
+            _, entry = self._users.popitem(last=False)
+            self.items -= len(entry[1])
+            self.evictions += 1
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'users': len(self._users),
+                'items': self.items,
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_ratio': round(self.hits / lookups, 3) if lookups else 0.0,
+                'evictions': self.evictions,
+                'invalidations': self.invalidations,
+            }
+
+
+notes_cache = UserCache(NOTES_CACHE_MAX_ITEMS, NOTES_CACHE_TTL)
+settings_cache = UserCache(SETTINGS_CACHE_MAX_ITEMS, SETTINGS_CACHE_TTL)
+
+# Чтение через кэш: при промахе вызываем load и сохраняем результат
+def cached(cache, user_id, key, load):
+    hit, value, generation = cache.lookup(user_id, key)
+    if hit:
+        return value
+    value = load()
+    cache.store(user_id, key, value, generation)
+    return value
+
+# Добавление заметки
+@timed_db
+def add_note(user_id, tag, note):
+    note_id = get_storage().add_note(user_id, tag, note)
+    notes_cache.invalidate(user_id)
+    return note_id
+
+# Получение заметки по id
+@timed_db
+def get_note(user_id, note_id):
+    return get_storage().get_note(user_id, note_id)
+
+# Поиск заметок по тегу, постранично по ключу:
+# tag_note_id - вместо тега передается id любой заметки с этим тегом (так тег не попадает в callback_data),
+# after_id - страница после заметки с этим id, before_id - страница перед ней.
+# Возвращает строки (id, tag, note) и признак того, что в этом направлении есть еще заметки
+@timed_db
+def find_notes(user_id, tag=None, after_id=None, before_id=None, limit=PAGE_SIZE, tag_note_id=None):
+    return cached(notes_cache, user_id, ('notes', tag, tag_note_id, after_id, before_id, limit),
+                  lambda: get_storage().find_notes(user_id, tag, after_id, before_id, limit, tag_note_id))
+
+# Поиск заметок по тексту и тегам, постранично со смещением (порядок - по релевантности)
+@timed_db
+def search_notes(user_id, query, offset=0, limit=PAGE_SIZE):
+    return cached(notes_cache, user_id, ('search', query, offset, limit),
+                  lambda: get_storage().search_notes(user_id, query, offset, limit))
+
+# Получение всех тегов заметок вместе с id одной из заметок с этим тегом
+@timed_db
+def get_all_tags(user_id):
+    return cached(notes_cache, user_id, ('tags',), lambda: get_storage().get_all_tags(user_id))
+
+# Изменение текста заметки (тег сохраняется). Возвращает False, если заметки уже нет
+@timed_db
+def update_note(user_id, note_id, note):
+    updated = get_storage().update_note(user_id, note_id, note)
+    if updated:
+        notes_cache.invalidate(user_id)
+    return updated
+
+# Удаление заметки (возвращает текст удаленной заметки или None)
+@timed_db
+def delete_note(user_id, note_id):
+    note = get_storage().delete_note(user_id, note_id)
+    if note is not None:
+        notes_cache.invalidate(user_id)
+    return note
+
+# Добавление напоминания (возвращает id); recurrence - правило повторения RRULE или None
+@timed_db
+def add_reminder(user_id, reminder_time, reminder_text, recurrence=None):
+    return get_storage().add_reminder(user_id, reminder_time, reminder_text, recurrence)
+
+# Получение напоминания по id
+@timed_db
+def get_reminder(user_id, reminder_id):
+    return get_storage().get_reminder(user_id, reminder_id)
+
+# Изменение времени, текста и правила повторения напоминания. Возвращает False, если напоминания уже нет
+@timed_db
+def update_reminder(user_id, reminder_id, reminder_time, reminder_text, recurrence=None):
+    return get_storage().update_reminder(user_id, reminder_id, reminder_time, reminder_text, recurrence)
+
+# Удаление напоминания (возвращает текст удаленного напоминания или None)
+@timed_db
+def delete_reminder(user_id, reminder_id):
+    return get_storage().delete_reminder(user_id, reminder_id)
+
+# Подтверждение отправленных напоминаний: тройки (id, отправленное время, время следующего срабатывания или None).
+# Разовые удаляются, у повторяющихся обновляется время - пакетами и только если время в базе
+# все еще совпадает с отправленным (пользователь не изменил напоминание, пока оно ждало отправки)
+@timed_db
+def ack_reminders(acks):
+    storage = get_storage()
+    done = [(reminder_id, utc_naive(reminder_time)) for reminder_id, reminder_time, next_time in acks if next_time is None]
+    schedule = [(utc_naive(next_time), reminder_id, utc_naive(reminder_time))
+                for reminder_id, reminder_time, next_time in acks if next_time is not None]
+    if done:
+        storage.delete_delivered_reminders(done)
+    if schedule:
+        storage.reschedule_reminders(schedule)
+
+# Захват наступивших напоминаний части shard с арендой на REMINDER_LEASE
+@timed_db
+def claim_reminders(shard, shards, limit):
+    now = datetime.now(timezone.utc)
+    return get_storage().claim_reminders(shard, shards, utc_naive(now), utc_naive(now + REMINDER_LEASE), limit)
+
+# Поиск напоминаний в интервале [start, end), постранично по ключу (reminder_time, id).
+# after/before - пара (reminder_time, id) крайнего напоминания соседней страницы.
+# Возвращает строки (id, reminder_time, reminder_text, recurrence) и признак того, что есть еще напоминания
+@timed_db
+def find_reminders(user_id, start=None, end=None, after=None, before=None, limit=PAGE_SIZE):
+    return get_storage().find_reminders(user_id, start, end, after, before, limit)
+
+# Время в базе хранится в UTC без пояса: границы выборок приводятся к тому же виду, чтобы работал индекс
+def utc_naive(moment):
+    return as_utc(moment).replace(tzinfo=None)
+
+# Границы дней [date, date + days) в часовом поясе пользователя, в UTC.
+# Каждая граница - полночь по местному времени, поэтому переходы на летнее время учитываются
+def local_days_range(date, tz, days=1):
+    end_date = date + timedelta(days=days)
+    start = datetime(date.year, date.month, date.day, tzinfo=tz)
+    end = datetime(end_date.year, end_date.month, end_date.day, tzinfo=tz)
+    return utc_naive(start), utc_naive(end)
+
+# Получение напоминаний на определенную дату пользователя (один диапазон по времени, чтобы работал индекс)
+def get_reminders_by_date(user_id, date, tz, after=None, before=None):
+    return find_reminders(user_id, *local_days_range(date, tz), after, before)
 
 # Получение напоминаний на неделю
-def get_reminders_for_week(user_id):
-    today = datetime.now().date()
-    next_week = today + timedelta(days=7)
-    with get_db_connection() as conn:
-        with conn.cursor() as c:
-            c.execute("SELECT reminder_time, reminder_text FROM reminders WHERE user_id=%s AND reminder_time BETWEEN %s AND %s ORDER BY reminder_time", 
-                      (user_id, today, next_week))
-            reminders = c.fetchall()
-    return reminders
-
-# Получение прошедших напоминаний
-def get_past_reminders(user_id):
-    today = datetime.now().date()
-    with get_db_connection() as conn:
-        with conn.cursor() as c:
-            c.execute("SELECT reminder_time, reminder_text FROM reminders WHERE user_id=%s AND reminder_time < %s ORDER BY reminder_time", 
-                      (user_id, today))
-            reminders = c.fetchall()
-    return reminders
+def get_reminders_for_week(user_id, tz, after=None, before=None):
+    return find_reminders(user_id, *local_days_range(datetime.now(tz).date(), tz, days=7), after, before)
+
+# Получение всех неотправленных напоминаний (для загрузки планировщика при старте)
+@timed_db
+def get_pending_reminders():
+    return get_storage().get_pending_reminders()
+
+# Получение прошедших напоминаний (до начала сегодняшнего дня пользователя)
+def get_past_reminders(user_id, tz, after=None, before=None):
+    today_start, _ = local_days_range(datetime.now(tz).date(), tz)
+    return find_reminders(user_id, None, today_start, after, before)
+
+# Удаление всех заметок и напоминаний пользователей
+@timed_db
+def delete_user_data(user_ids):
+    get_storage().delete_user_data(user_ids)
+    for user_id in user_ids:
+        notes_cache.invalidate(user_id)
+        settings_cache.invalidate(user_id)
+
+RE_UTC_OFFSET = re.compile(r'^(?:utc|gmt)?\s*([+-])(\d{1,2})(?::?(\d{2}))?$', re.IGNORECASE)
+# Пояса Etc/GMT±N (их сохраняли прежние версии команды /timezone) имеют обратный знак: Etc/GMT-5 - это UTC+5
+RE_ETC_GMT = re.compile(r'^Etc/GMT([+-])(\d{1,2})$')
+
+# Фиксированное смещение от UTC с именем вида UTC+05:30 или None, если имя - не смещение или оно вне диапазона
+def fixed_offset_zone(timezone_name):
+    match = RE_UTC_OFFSET.match(timezone_name)
+    if match:
+        sign, hours, minutes = match.groups()
+    else:
+        match = RE_ETC_GMT.match(timezone_name)
+        if not match:
+            return None
+        sign, hours = match.groups()
+        sign, minutes = ('-' if sign == '+' else '+'), None
+    hours, minutes = int(hours), int(minutes or 0)
+    if minutes >= 60 or hours * 60 + minutes > 14 * 60:
+        return None
+    if not hours and not minutes:
+        return timezone.utc
+    offset = timedelta(hours=hours, minutes=minutes)
+    return timezone(offset if sign == '+' else -offset, f"UTC{sign}{hours:02}:{minutes:02}")
+
+# Часовой пояс по имени; неизвестное или пустое имя - пояс по умолчанию
+def zone_or_default(timezone_name):
+    if timezone_name:
+        zone = fixed_offset_zone(timezone_name)
+        if zone is not None:
+            return zone
+        try:
+            return ZoneInfo(timezone_name)
+        except (ZoneInfoNotFoundError, ValueError):
+            logger.warning(f"Неизвестный часовой пояс {timezone_name}, используется {DEFAULT_TIMEZONE_NAME}")
+    return DEFAULT_TIMEZONE
+
+@timed_db
+def load_user_timezone(user_id):
+    return get_storage().get_user_timezone(user_id)
+
+@timed_db
+def set_user_timezone(user_id, timezone_name):
+    get_storage().set_user_timezone(user_id, timezone_name)
+    settings_cache.invalidate(user_id)
+
+# Часовой пояс пользователя: из кэша без обращения к пулу потоков, при промахе - из базы
+async def user_timezone(user_id):
+    hit, tz, generation = settings_cache.lookup(user_id, ('timezone',))
+    if hit:
+        return tz
+    tz = zone_or_default(await run_db(load_user_timezone, user_id))
+    settings_cache.store(user_id, ('timezone',), tz, generation)
+    return tz
+
+# Формат выгрузки: JSON Lines (по объекту на строку) или CSV с этими столбцами.
+# Время напоминаний - ISO 8601 в UTC, при загрузке время без пояса считается временем пользователя
+EXPORT_FIELDS = ('type', 'tag', 'text', 'time', 'recurrence')
+
+# Выгрузка заметок и напоминаний пользователя в файл out построчно. Возвращает число записей
+@timed_db
+def export_user_data(user_id, out, file_format):
+    storage = get_storage()
+    text = io.TextIOWrapper(out, encoding='utf-8', newline='')
+    if file_format == 'csv':
+        writer = csv.DictWriter(text, EXPORT_FIELDS)
+        writer.writeheader()
+        write = writer.writerow
+    else:
+        write = lambda record: text.write(json.dumps(record, ensure_ascii=False) + '\n')
+    count = 0
+    for tag, note in storage.iter_notes(user_id, EXPORT_BATCH_SIZE):
+        write({'type': 'note', 'tag': tag, 'text': note})
+        count += 1
+    for reminder_time, reminder_text, recurrence in storage.iter_reminders(user_id, EXPORT_BATCH_SIZE):
+        record = {'type': 'reminder', 'text': reminder_text, 'time': as_utc(reminder_time).isoformat()}
+        if recurrence:
+            record['recurrence'] = recurrence
+        write(record)
+        count += 1
+    text.flush()
+    text.detach()
+    return count
+
+# Записи загружаемого файла; None - строка, которую не удалось прочитать
+def read_import_records(text, file_format):
+    if file_format == 'csv':
+        yield from csv.DictReader(text)
+        return
+    for line in text:
+        if not line.strip():
+            continue
+        try:
+            record = json.loads(line)
+        except ValueError:
+            record = None
+        yield record if isinstance(record, dict) else None
+
+# Строка для вставки из записи файла: ('note', строка) или ('reminder', строка); None - запись пропускается.
+# Прошедшие разовые напоминания пропускаются, повторяющиеся переносятся на следующее срабатывание.
+# Правило повторения проверяется так же, как при вводе в сообщении
+def import_record(user_id, record, tz, now):
+    if record is None:
+        return None
+    kind = record.get('type')
+    text = str(record.get('text') or '').strip()
+    if not text:
+        return None
+    if kind == 'note':
+        return 'note', (user_id, str(record.get('tag') or '').strip() or '#импорт', text)
+    if kind != 'reminder':
+        return None
+    try:
+        time_text = str(record.get('time') or '').strip()
+        # fromisoformat до Python 3.11 не понимает суффикс Z
+        if time_text[-1:] in ('Z', 'z'):
+            time_text = time_text[:-1] + '+00:00'
+        reminder_time = datetime.fromisoformat(time_text)
+        if reminder_time.tzinfo is None:
+            reminder_time = reminder_time.replace(tzinfo=tz)
+        recurrence = str(record.get('recurrence') or '').strip() or None
+        if recurrence:
+            recurrence = check_recurrence(recurrence, reminder_time)
+        if recurrence and reminder_time <= now:
+            reminder_time = next_occurrence(recurrence, reminder_time, now, tz)
+    except ValueError:
+        return None
+    if reminder_time is None or reminder_time <= now:
+        return None
+    return 'reminder', (user_id, utc_naive(reminder_time), text, recurrence)
+
+# Загрузка заметок и напоминаний из файла source пачками по IMPORT_BATCH_SIZE строк.
+# Возвращает число заметок, добавленные напоминания (для планировщика) и число пропущенных записей
+@timed_db
+def import_user_data(user_id, source, file_format, tz):
+    storage = get_storage()
+    now = datetime.now(timezone.utc)
+    notes, reminders, added_reminders = [], [], []
+    notes_count = skipped = 0
+    text = io.TextIOWrapper(source, encoding='utf-8-sig', newline='')
+    try:
+        for record in read_import_records(text, file_format):
+            row = import_record(user_id, record, tz, now)
+            if row is None:
+                skipped += 1
+            elif row[0] == 'note':
+                notes.append(row[1])
+            else:
+                reminders.append(row[1])
+            if len(notes) >= IMPORT_BATCH_SIZE:
+                storage.add_notes(notes)
+                notes_count += len(notes)
+                notes = []
+            if len(reminders) >= IMPORT_BATCH_SIZE:
+                added_reminders += storage.add_reminders(reminders)
+                reminders = []
+        if notes:
+            storage.add_notes(notes)
+            notes_count += len(notes)
+        if reminders:
+            added_reminders += storage.add_reminders(reminders)
+    finally:
+        notes_cache.invalidate(user_id)
+        text.detach()
+    return notes_count, added_reminders, skipped
+
+
+# Хранение user_data (действие пользователя и id редактируемой записи) в базе, чтобы незаконченные
+# диалоги переживали перезапуск и были видны всем копиям бота. Данные живут в памяти приложения,
+# изменения копятся и записываются одной пачкой в фоне, не задерживая обработку обновления.
+# Остальные виды данных (chat_data, bot_data, диалоги) бот не использует и не хранит
+class DbPersistence(BasePersistence):
+    def __init__(self, flush_interval, refresh_ttl):
+        super().__init__(store_data=PersistenceInput(bot_data=False, chat_data=False, user_data=True, callback_data=False),
+                         update_interval=flush_interval)
+        self.refresh_ttl = refresh_ttl
+        # Последний записанный или прочитанный JSON пользователя и время последней сверки с базой
+        self._known = {}
+        self._refreshed_at = {}
+        # Ожидающие записи: user_id -> JSON (None - удалить состояние)
+        self._pending = {}
+        self._flush_task = None
+        self.writes = 0
+        self.batches = 0
+        self.refreshes = 0
+        self.errors = 0
+
+    async def get_user_data(self):
+        rows = await run_db(get_storage().get_user_states)
+        user_data = {}
+        now = time.monotonic()
+        for user_id, data in rows:
+            user_data[user_id] = json.loads(data)
+            self._known[user_id] = data
+            self._refreshed_at[user_id] = now
+        logger.info(f"Загружено состояний пользователей: {len(user_data)}")
+        return user_data
+
+    async def update_user_data(self, user_id, data):
+        data = json.dumps(data, ensure_ascii=False, sort_keys=True) if data else None
+        if data == self._known.get(user_id):
+            return
+        self._known[user_id] = data
+        self._pending[user_id] = data
+        if self._flush_task is None:
+            self._flush_task = asyncio.create_task(self._flush_pending())
+
+    async def drop_user_data(self, user_id):
+        await self.update_user_data(user_id, None)
+
+    # Перед обработкой обновления сверяем состояние с базой, если его могла изменить другая копия бота
+    async def refresh_user_data(self, user_id, user_data):
+        if not self.refresh_ttl or user_id in self._pending:
+            return
+        now = time.monotonic()
+        if now - self._refreshed_at.get(user_id, 0) < self.refresh_ttl:
+            return
+        self._refreshed_at[user_id] = now
+        self.refreshes += 1
+        rows = await run_db(get_storage().get_user_states, [user_id])
+        data = rows[0][1] if rows else None
+        if user_id in self._pending or data == self._known.get(user_id):
+            return
+        self._known[user_id] = data
+        user_data.clear()
+        if data:
+            user_data.update(json.loads(data))
+
+    # Фоновая запись: все изменения, накопленные к моменту записи, уходят одной пачкой
+    async def _flush_pending(self):
+        try:
+            await asyncio.sleep(0)
+            while self._pending:
+                pending, self._pending = self._pending, {}
+                try:
+                    await run_db(save_user_states, pending)
+                except Exception as e:
+                    self.errors += 1
+                    logger.error(f"Ошибка при сохранении состояния пользователей: {e}")
+                    # Возвращаем неудачную пачку, не затирая более свежие изменения
+                    self._pending = {**pending, **self._pending}
+                    await asyncio.sleep(self.update_interval)
+                    continue
+                self.writes += len(pending)
+                self.batches += 1
+        finally:
+            self._flush_task = None
+
+    async def flush(self):
+        if self._flush_task is not None:
+            await self._flush_task
+        if self._pending:
+            pending, self._pending = self._pending, {}
+            await run_db(save_user_states, pending)
+
+    def stats(self):
+        return {'users': len(self._known), 'pending': len(self._pending), 'writes': self.writes,
+                'batches': self.batches, 'refreshes': self.refreshes, 'errors': self.errors}
+
+    async def get_chat_data(self):
+        return {}
+
+    async def get_bot_data(self):
+        return {}
+
+    async def get_callback_data(self):
+        return None
+
+    async def get_conversations(self, name):
+        return {}
+
+    async def update_chat_data(self, chat_id, data):
+        pass
+
+    async def update_bot_data(self, data):
+        pass
+
+    async def update_callback_data(self, data):
+        pass
+
+    async def update_conversation(self, name, key, new_state):
+        pass
+
+    async def drop_chat_data(self, chat_id):
+        pass
+
+    async def refresh_chat_data(self, chat_id, chat_data):
+        pass
+
+    async def refresh_bot_data(self, bot_data):
+        pass
+
+# Запись пачки состояний: новые и измененные - одним запросом, опустевшие удаляются
+@timed_db
+def save_user_states(states):
+    storage = get_storage()
+    updated = {user_id: data for user_id, data in states.items() if data is not None}
+    dropped = [user_id for user_id, data in states.items() if data is None]
+    if updated:
+        storage.save_user_states(updated)
+    if dropped:
+        storage.delete_user_states(dropped)
+
+# Приводим время к UTC с явным часовым поясом (в базе хранится UTC без пояса)
+def as_utc(moment):
+    if moment.tzinfo is None:
+        return moment.replace(tzinfo=timezone.utc)
+    return moment.astimezone(timezone.utc)
+
+# Разобранные правила повторения кэшируются, для каждого расчета подставляется только dtstart
+@lru_cache(maxsize=1024)
+def recurrence_rule(recurrence):
+    return rrulestr(recurrence)
+
+# Проверка правила повторения из сообщения или файла загрузки: правило в верхнем регистре без префикса RRULE:
+# или ValueError, если правило некорректно или у него нет срабатываний от start.
+# COUNT не поддерживается: он считался бы заново от каждого срабатывания - для ограничения используйте UNTIL
+def check_recurrence(recurrence, start):
+    recurrence = recurrence.strip().upper()
+    if recurrence.startswith('RRULE:'):
+        recurrence = recurrence[len('RRULE:'):]
+    if not recurrence.startswith('FREQ=') or 'COUNT=' in recurrence:
+        raise ValueError(f"Неподдерживаемое правило повторения: {recurrence}")
+    if recurrence_rule(recurrence).replace(dtstart=start).after(start, inc=True) is None:
+        raise ValueError(f"У правила повторения нет срабатываний: {recurrence}")
+    return recurrence
+
+# Следующее после now срабатывание повторяющегося напоминания (в UTC) или None, если правило закончилось.
+# Правило считается от текущего срабатывания в часовом поясе пользователя, чтобы напоминание "в 9:00" оставалось в 9:00;
+# пропущенные срабатывания (бот был остановлен) не догоняются
+def next_occurrence(recurrence, reminder_time, now, tz):
+    start = as_utc(reminder_time).astimezone(tz)
+    following = recurrence_rule(recurrence).replace(dtstart=start).after(max(as_utc(now), start))
+    return following.astimezone(timezone.utc) if following else None
+
+# Планировщик напоминаний: куча по времени срабатывания в памяти,
+# JobQueue взводится ровно на время ближайшего напоминания вместо периодического опроса таблицы
+class ReminderScheduler:
+    JOB_NAME = 'check_reminders'
+
+    # Выключенный планировщик (режим нескольких процессов) ничего не хранит: напоминания берутся из базы
+    def __init__(self, enabled=True):
+        self.enabled = enabled
+        self._heap = []
+        self._entries = {}
+        # Порядковый номер записи - второй элемент: при равном времени кучи сравнивают его, а не остальные поля
+        self._counter = itertools.count()
+        self._job_queue = None
+        self._job = None
+        self._armed_for = None
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, reminder_id):
+        return reminder_id in self._entries
+
+    def attach(self, job_queue):
+        self._job_queue = job_queue
+        self._arm()
+
+    def load(self, reminders):
+        if not self.enabled:
+            return
+        for reminder_id, user_id, reminder_time, reminder_text, recurrence in reminders:
+            self._push(reminder_id, user_id, reminder_time, reminder_text, recurrence, reminder_time)
+        self._arm()
+
+    # reminder_time - время напоминания в базе (по нему подтверждается отправка),
+    # due_at - когда отправить, если отличается (повтор после неудачной отправки)
+    def add(self, reminder_id, user_id, reminder_time, reminder_text, recurrence=None, due_at=None):
+        if not self.enabled:
+            return
+        self._push(reminder_id, user_id, reminder_time, reminder_text, recurrence, due_at or reminder_time)
+        self._arm()
+
+    def discard(self, *reminder_ids):
+        for reminder_id in reminder_ids:
+            self._cancel(reminder_id)
+        self._arm()
+
+    def pop_due(self, now):
+        due = []
+        while self._heap and self._heap[0][0] <= now:
+            _, _, reminder_id, user_id, reminder_time, reminder_text, recurrence, alive = heapq.heappop(self._heap)
+            if not alive:
+                continue
+            del self._entries[reminder_id]
+            due.append((reminder_id, user_id, reminder_time, reminder_text, recurrence))
+        return due
+
+    def next_time(self):
+        while self._heap and not self._heap[0][-1]:
+            heapq.heappop(self._heap)
+        return self._heap[0][0] if self._heap else None
+
+    # Удаленные напоминания только помечаются, из кучи они уходят при следующем извлечении
+    def _cancel(self, reminder_id):
+        entry = self._entries.pop(reminder_id, None)
+        if entry is not None:
+            entry[-1] = False
+
+    def _push(self, reminder_id, user_id, reminder_time, reminder_text, recurrence, due_at):
+        self._cancel(reminder_id)
+        entry = [as_utc(due_at), next(self._counter), reminder_id, user_id, reminder_time, reminder_text, recurrence, True]
+        heapq.heappush(self._heap, entry)
+        self._entries[reminder_id] = entry
+
+    def _arm(self):
+        if self._job_queue is None:
+            return
+        next_time = self.next_time()
+        if next_time == self._armed_for:
+            return
+        if self._job is not None:
+            self._job.schedule_removal()
+            self._job = None
+        self._armed_for = next_time
+        if next_time is not None:
+            when = max(next_time, datetime.now(timezone.utc))
+            self._job = self._job_queue.run_once(check_reminders, when=when, name=self.JOB_NAME)
+
+    # Вызывается при срабатывании задачи: разовая задача уже снята с JobQueue
+    def job_fired(self):
+        self._job = None
+        self._armed_for = None
+
+    def arm(self):
+        self._arm()
+
+
+reminder_scheduler = ReminderScheduler(enabled=not USE_REMINDER_CLAIMS)
+
+# Ограничение скорости отправки: общий лимит сообщений в секунду и минимальный интервал для одного чата
+class SendRateLimiter:
+    def __init__(self, global_rate, chat_interval):
+        self._global_interval = 1.0 / global_rate
+        self._chat_interval = chat_interval
+        self._next_global = 0.0
+        self._next_chat = {}
+
+    # Telegram попросил подождать (RetryAfter) - приостанавливаем все отправки
+    def pause(self, seconds):
+        loop = asyncio.get_running_loop()
+        self._next_global = max(self._next_global, loop.time() + seconds)
+
+    async def wait(self, chat_id):
+        loop = asyncio.get_running_loop()
+        now = loop.time()
+        chat_at = max(now, self._next_chat.get(chat_id, 0.0))
+        self._next_chat[chat_id] = chat_at + self._chat_interval
+        if chat_at > now:
+            await asyncio.sleep(chat_at - now)
+            now = loop.time()
+        global_at = max(now, self._next_global)
+        self._next_global = global_at + self._global_interval
+        if global_at > now:
+            await asyncio.sleep(global_at - now)
+        if len(self._next_chat) > 10000:
+            self._next_chat = {chat: at for chat, at in self._next_chat.items() if at > now}
+
+
+# Конвейер отправки напоминаний: ограниченная очередь, несколько параллельных отправителей,
+# повторы при RetryAfter и сетевых ошибках, пакетное удаление отправленных напоминаний раз в тик
+class ReminderDelivery:
+    def __init__(self):
+        self._queue = None
+        self._limiter = SendRateLimiter(REMINDER_SEND_RATE, TELEGRAM_CHAT_INTERVAL)
+        self._bot = None
+        self._tasks = []
+        self._acks = []
+        self.enqueued_total = 0
+        self.sent_total = 0
+        self.failed_total = 0
+        self.retries_total = 0
+        self.acked_total = 0
+        self.expired_total = 0
+        self._in_flight = 0
+        self.lag_seconds_last = 0.0
+        self.lag_seconds_max = 0.0
+        self._lag_seconds_sum = 0.0
+
+    def start(self, bot):
+        self._bot = bot
+        self._queue = asyncio.Queue(maxsize=REMINDER_QUEUE_SIZE)
+        self._tasks = [asyncio.create_task(self._worker()) for _ in range(REMINDER_SEND_CONCURRENCY)]
+        self._tasks.append(asyncio.create_task(self._ack_loop()))
+
+    async def stop(self):
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+        await self._flush_acks()
+
+    # Сколько напоминаний еще поместится в очередь
+    def capacity(self):
+        return self._queue.maxsize - self._queue.qsize() if self._queue else 0
+
+    # Сколько напоминаний ждут отправки или отправляются
+    def backlog(self):
+        return self._queue.qsize() + self._in_flight if self._queue else 0
+
+    # expires_at (время цикла событий) - до какого момента напоминание можно отправлять (захват с арендой)
+    async def enqueue(self, reminder, expires_at=None):
+        self.enqueued_total += 1
+        await self._queue.put((reminder, expires_at))
+
+    def stats(self):
+        return {
+            'queue_depth': self._queue.qsize() if self._queue else 0,
+            'enqueued_total': self.enqueued_total,
+            'sent_total': self.sent_total,
+            'failed_total': self.failed_total,
+            'retries_total': self.retries_total,
+            'acked_total': self.acked_total,
+            'expired_total': self.expired_total,
+            'pending_acks': len(self._acks),
+            'lag_seconds_last': round(self.lag_seconds_last, 3),
+            'lag_seconds_max': round(self.lag_seconds_max, 3),
+            'lag_seconds_avg': round(self._lag_seconds_sum / self.sent_total, 3) if self.sent_total else 0.0,
+        }
+
+    async def _worker(self):
+        while True:
+            reminder, expires_at = await self._queue.get()
+            self._in_flight += 1
+            try:
+                await self._deliver(reminder, expires_at)
+            except Exception as e:
+                logger.error(f"Ошибка в конвейере отправки напоминаний: {e}")
+            finally:
+                self._in_flight -= 1
+                self._queue.task_done()
+
+    async def _deliver(self, reminder, expires_at=None):
+        reminder_id, user_id, reminder_time, reminder_text, recurrence = reminder
+        loop = asyncio.get_running_loop()
+        for attempt in range(1, REMINDER_SEND_ATTEMPTS + 1):
+            await self._limiter.wait(user_id)
+            if expires_at is not None and loop.time() > expires_at:
+                # Аренда заканчивается - напоминание может захватить другой процесс, отправлять его уже нельзя
+                logger.warning(f"Аренда напоминания {reminder_id} истекла до отправки, оно будет захвачено повторно")
+                self.expired_total += 1
+                return
+            try:
+                await self._bot.send_message(chat_id=user_id, text=f"⏰ Напоминание: {reminder_text}")
+            except RetryAfter as e:
+                TELEGRAM_ERRORS.inc('RetryAfter')
+                self.retries_total += 1
+                self._limiter.pause(e.retry_after)
+                continue
+            except (Forbidden, BadRequest) as e:
+                # Пользователь заблокировал бота или чат недоступен - повтор не поможет
+                TELEGRAM_ERRORS.inc(type(e).__name__)
+                logger.error(f"Напоминание {reminder_id} не может быть доставлено пользователю {user_id}: {e}")
+                self.failed_total += 1
+                await self._ack(reminder)
+                return
+            except NetworkError as e:
+                TELEGRAM_ERRORS.inc(type(e).__name__)
+                self.retries_total += 1
+                logger.warning(f"Сетевая ошибка при отправке напоминания {reminder_id} (попытка {attempt}): {e}")
+                if attempt < REMINDER_SEND_ATTEMPTS:
+                    await asyncio.sleep(min(2 ** attempt, 30))
+                continue
+            lag = (datetime.now(timezone.utc) - as_utc(reminder_time)).total_seconds()
+            REMINDER_LAG_SECONDS.observe(lag)
+            self.sent_total += 1
+            self.lag_seconds_last = lag
+            self.lag_seconds_max = max(self.lag_seconds_max, lag)
+            self._lag_seconds_sum += lag
+            await self._ack(reminder)
+            return
+        self.failed_total += 1
+        if recurrence:
+            # У повторяющегося напоминания пропускаем это срабатывание и ждем следующего
+            logger.error(f"Не удалось отправить напоминание {reminder_id} пользователю {user_id}, ждем следующего повтора")
+            await self._ack(reminder)
+            return
+        # Попытки исчерпаны - напоминание остается в базе, планировщик (или другой захват после аренды) вернется к нему позже
+        logger.error(f"Не удалось отправить напоминание {reminder_id} пользователю {user_id}, повтор через {REMINDER_RETRY_DELAY}")
+        reminder_scheduler.add(reminder_id, user_id, reminder_time, reminder_text,
+                               due_at=datetime.now(timezone.utc) + REMINDER_RETRY_DELAY)
+
+    # Разовое напоминание будет удалено из базы, повторяющееся - перенесено на следующее срабатывание
+    async def _ack(self, reminder):
+        reminder_id, user_id, reminder_time, reminder_text, recurrence = reminder
+        next_time = None
+        if recurrence:
+            try:
+                tz = await user_timezone(user_id)
+                next_time = next_occurrence(recurrence, reminder_time, datetime.now(timezone.utc), tz)
+            except ValueError as e:
+                logger.error(f"Некорректное правило повторения напоминания {reminder_id} ({recurrence}): {e}")
+            # Если напоминание уже снова в планировщике, пользователь изменил его во время отправки -
+            # старый текст и время не возвращаем
+            if next_time is not None and reminder_id not in reminder_scheduler:
+                reminder_scheduler.add(reminder_id, user_id, next_time, reminder_text, recurrence)
+        self._acks.append((reminder_id, reminder_time, next_time))
+
+    async def _ack_loop(self):
+        while True:
+            await asyncio.sleep(REMINDER_ACK_INTERVAL)
+            await self._flush_acks()
+
+    async def _flush_acks(self):
+        if not self._acks:
+            return
+        acks, self._acks = self._acks, []
+        try:
+            await run_db(ack_reminders, acks)
+            self.acked_total += len(acks)
+        except Exception as e:
+            logger.error(f"Ошибка при подтверждении отправленных напоминаний: {e}")
+            self._acks.extend(acks)
+
+
+reminder_delivery = ReminderDelivery()
+
+# Формат callback_data: короткий код действия и аргументы через двоеточие, например "nd:123".
+# Вместо текстов заметок и напоминаний передаются их id, поэтому данные всегда укладываются в 64 байта
+CB_EDIT_NOTE = 'ne'
+CB_DELETE_NOTE = 'nd'
+CB_EDIT_REMINDER = 're'
+CB_DELETE_REMINDER = 'rd'
+CB_TAG = 'tg'
+CB_NOTES_PAGE = 'np'
+CB_REMINDERS_PAGE = 'rp'
+CB_SEARCH_PAGE = 'sp'
+
+def encode_callback(code, *args):
+    return ':'.join([code, *map(str, args)])
+
+def callback_args(query):
+    return query.data.split(':')[1:]
 
 # Главное меню с Inline-клавиатурой и Reply-клавиатурой
+@timed_handler
 async def start(update: Update, context) -> None:
     inline_keyboard = [
         [InlineKeyboardButton("Добавить заметку", callback_data=ACTION_ADD_NOTE)],
@@ -152,10 +2107,9 @@ async def start(update: Update, context) -> None:
 # Меню заметок
 async def notes_menu(update: Update, context) -> None:
     query = update.callback_query
-    await query.answer()
     keyboard = [
         [InlineKeyboardButton("Все теги заметок", callback_data='all_tags')],
-        [InlineKeyboardButton("Поиск по тегу", callback_data='find_note')],
+        [InlineKeyboardButton("Поиск заметок", callback_data='find_note')],
         [InlineKeyboardButton("Все заметки", callback_data='all_notes')]
     ]
     reply_markup = InlineKeyboardMarkup(keyboard)
@@ -164,7 +2118,6 @@ async def notes_menu(update: Update, context) -> None:
 # Меню напоминаний
 async def reminders_menu(update: Update, context) -> None:
     query = update.callback_query
-    await query.answer()
     keyboard = [
         [InlineKeyboardButton("Напоминания на сегодня", callback_data='today_reminders')],
         [InlineKeyboardButton("Напоминания на завтра", callback_data='tomorrow_reminders')],
@@ -177,152 +2130,548 @@ async def reminders_menu(update: Update, context) -> None:
 # Отображение всех тегов заметок
 async def all_tags(update: Update, context) -> None:
     query = update.callback_query
-    await query.answer()
     user_id = query.from_user.id
-    tags = get_all_tags(user_id)
+    tags = await run_db(get_all_tags, user_id)
 
     if tags:
-        keyboard = [[InlineKeyboardButton(tag[0], callback_data=f"tag_{tag[0]}")] for tag in tags]
+        keyboard = [[InlineKeyboardButton(tag, callback_data=encode_callback(CB_TAG, note_id))] for tag, note_id in tags]
         reply_markup = InlineKeyboardMarkup(keyboard)
         await query.edit_message_text(text="Все теги заметок:", reply_markup=reply_markup)
     else:
         await query.edit_message_text(text="У вас нет заметок с тегами.")
 
-# Отображение заметок по тегу
-async def show_notes_by_tag(update: Update, context) -> None:
+# Сокращение длинного текста для списка
+def preview(text):
+    if len(text) <= PREVIEW_LENGTH:
+        return text
+    return text[:PREVIEW_LENGTH - 1] + "…"
+
+# Кнопки перехода между страницами
+def page_navigation(has_prev, has_next, prev_data, next_data):
+    buttons = []
+    if has_prev:
+        buttons.append(InlineKeyboardButton("⬅️", callback_data=prev_data))
+    if has_next:
+        buttons.append(InlineKeyboardButton("➡️", callback_data=next_data))
+    return [buttons] if buttons else []
+
+# Страница заметок одним сообщением; листание редактирует это же сообщение.
+# tag_note_id - id заметки, тег которой показываем (0 - все заметки)
+async def show_notes_page(update: Update, context, tag_note_id=0, after_id=None, before_id=None):
     query = update.callback_query
-    await query.answer()
     user_id = query.from_user.id
-    tag = query.data.split('_', 1)[1]
-    notes = find_notes(user_id, tag)
-
-    if notes:
-        for note in notes:
-            keyboard = [
-                [InlineKeyboardButton("✏️", callback_data=f"edit_note_{note[0]}"),
-                 InlineKeyboardButton("❌", callback_data=f"delete_note_{note[0]}")]
-            ]
-            reply_markup = InlineKeyboardMarkup(keyboard)
-            await query.message.reply_text(f"Тег: {tag}\nЗаметка: {note[0]}", reply_markup=reply_markup)
-    else:
-        await query.edit_message_text(text=f"Заметок с тегом {tag} не найдено.")
+    notes, has_more = await run_db(find_notes, user_id, None, after_id, before_id, tag_note_id=tag_note_id)
+
+    if not notes:
+        if tag_note_id:
+            await query.edit_message_text(text="Заметок с этим тегом не найдено.")
+        else:
+            await query.edit_message_text(text="У вас нет заметок.")
+        return
+
+    lines = [f"Заметки с тегом {notes[0][1]}:" if tag_note_id else "Все заметки:"]
+    keyboard = []
+    for number, (note_id, note_tag, note) in enumerate(notes, 1):
+        lines.append(f"{number}. {note_tag} {preview(note)}")
+        keyboard.append([InlineKeyboardButton(f"✏️ {number}", callback_data=encode_callback(CB_EDIT_NOTE, note_id)),
+                         InlineKeyboardButton(f"❌ {number}", callback_data=encode_callback(CB_DELETE_NOTE, note_id))])
+    # Листание назад: есть предыдущие, если пришли со следующей страницы или при движении назад нашлись еще
+    has_prev = after_id is not None or (before_id is not None and has_more)
+    has_next = before_id is not None or has_more
+    keyboard += page_navigation(has_prev, has_next,
+                                encode_callback(CB_NOTES_PAGE, tag_note_id, 'p', notes[0][0]),
+                                encode_callback(CB_NOTES_PAGE, tag_note_id, 'n', notes[-1][0]))
+    await query.edit_message_text(text="\n".join(lines), reply_markup=InlineKeyboardMarkup(keyboard))
+
+# Отображение заметок по тегу: tg:<id заметки с этим тегом>
+async def show_notes_by_tag(update: Update, context) -> None:
+    tag_note_id, = callback_args(update.callback_query)
+    await show_notes_page(update, context, int(tag_note_id))
 
 # Отображение всех заметок
 async def all_notes(update: Update, context) -> None:
+    await show_notes_page(update, context)
+
+# Листание заметок: np:<id заметки с тегом или 0>:<n|p>:<id крайней заметки>
+async def notes_page(update: Update, context) -> None:
+    tag_note_id, direction, cursor = callback_args(update.callback_query)
+    if direction == 'n':
+        await show_notes_page(update, context, int(tag_note_id), after_id=int(cursor))
+    else:
+        await show_notes_page(update, context, int(tag_note_id), before_id=int(cursor))
+
+# Результаты поиска заметок. Текст запроса хранится в user_data (в callback_data он может не поместиться),
+# страница задается смещением. Новым сообщением при вводе запроса, редактированием при листании
+async def show_search_results(update: Update, context, offset=0):
     query = update.callback_query
-    await query.answer()
-    user_id = query.from_user.id
-    notes = find_notes(user_id, "")
-
-    if notes:
-        for note in notes:
-            keyboard = [
-                [InlineKeyboardButton("✏️", callback_data=f"edit_note_{note[0]}"),
-                 InlineKeyboardButton("❌", callback_data=f"delete_note_{note[0]}")]
-            ]
-            reply_markup = InlineKeyboardMarkup(keyboard)
-            await query.message.reply_text(f"Заметка: {note[0]}", reply_markup=reply_markup)
+    user_id = update.effective_user.id
+    search_query = context.user_data.get('search_query')
+    if query:
+        send = query.edit_message_text
     else:
-        await query.edit_message_text(text="У вас нет заметок.")
+        send = update.message.reply_text
+    if not search_query:
+        await send(text="Поиск устарел, начните новый: /search текст")
+        return
+
+    notes, has_more = await run_db(search_notes, user_id, search_query, offset)
+    if not notes:
+        await send(text=f"По запросу «{search_query}» ничего не найдено.")
+        return
+
+    lines = [f"Результаты поиска «{search_query}»:"]
+    keyboard = []
+    for number, (note_id, note_tag, note) in enumerate(notes, offset + 1):
+        lines.append(f"{number}. {note_tag} {preview(note)}")
+        keyboard.append([InlineKeyboardButton(f"✏️ {number}", callback_data=encode_callback(CB_EDIT_NOTE, note_id)),
+                         InlineKeyboardButton(f"❌ {number}", callback_data=encode_callback(CB_DELETE_NOTE, note_id))])
+    keyboard += page_navigation(offset > 0, has_more,
+                                encode_callback(CB_SEARCH_PAGE, max(offset - PAGE_SIZE, 0)),
+                                encode_callback(CB_SEARCH_PAGE, offset + PAGE_SIZE))
+    await send(text="\n".join(lines), reply_markup=InlineKeyboardMarkup(keyboard))
+
+# Команда /search <текст>; без текста бот попросит ввести запрос
+@timed_handler
+async def search_command(update: Update, context) -> None:
+    search_query = ' '.join(context.args).strip()
+    if not search_query:
+        context.user_data['action'] = ACTION_SEARCH_NOTES
+        await update.message.reply_text("Введите текст или тег для поиска:")
+        return
+    context.user_data['search_query'] = search_query
+    await show_search_results(update, context)
+
+# Листание результатов поиска: sp:<смещение>
+async def search_page(update: Update, context) -> None:
+    offset, = callback_args(update.callback_query)
+    await show_search_results(update, context, int(offset))
+
+# Курсор страницы напоминаний: время в микросекундах от начала эпохи и id
+EPOCH = datetime(1970, 1, 1)
+
+def encode_reminder_cursor(reminder_time, reminder_id):
+    micros = (as_utc(reminder_time).replace(tzinfo=None) - EPOCH) // timedelta(microseconds=1)
+    return micros, reminder_id
+
+def decode_reminder_cursor(micros, reminder_id):
+    return EPOCH + timedelta(microseconds=int(micros)), int(reminder_id)
 
-# Отображение напоминаний
-async def show_reminders(update: Update, context, reminders, message_text):
+# Периоды списков напоминаний: заголовок, текст для пустого списка и функция выборки
+REMINDER_PERIODS = {
+    'today': ("Напоминания на сегодня", "напоминаний на сегодня",
+              lambda user_id, tz, **page: get_reminders_by_date(user_id, datetime.now(tz).date(), tz, **page)),
+    'tomorrow': ("Напоминания на завтра", "напоминаний на завтра",
+                 lambda user_id, tz, **page: get_reminders_by_date(user_id, datetime.now(tz).date() + timedelta(days=1), tz, **page)),
+    'week': ("Напоминания на неделю", "напоминаний на неделю", get_reminders_for_week),
+    'past': ("Прошлые напоминания", "прошедших напоминаний", get_past_reminders),
+}
+
+# Страница напоминаний за период одним сообщением
+async def show_reminders(update: Update, context, period, after=None, before=None):
     query = update.callback_query
-    await query.answer()
     user_id = query.from_user.id
+    title, message_text, fetch = REMINDER_PERIODS[period]
+    tz = await user_timezone(user_id)
+    reminders, has_more = await run_db(fetch, user_id, tz, after=after, before=before)
 
-    if reminders:
-        for reminder in reminders:
-            reminder_time = reminder[0]
-            reminder_text = reminder[1]
-            keyboard = [
-                [InlineKeyboardButton("✏️", callback_data=f"edit_reminder_{reminder_text}"),
-                 InlineKeyboardButton("❌", callback_data=f"delete_reminder_{reminder_text}")]
-            ]
-            reply_markup = InlineKeyboardMarkup(keyboard)
-            await query.message.reply_text(f"{message_text} {reminder_time.strftime('%Y-%m-%d %H:%M')}:\n{reminder_text}", reply_markup=reply_markup)
-    else:
+    if not reminders:
         await query.edit_message_text(text=f"У вас нет {message_text}.")
+        return
+
+    lines = [f"{title}:"]
+    keyboard = []
+    for number, (reminder_id, reminder_time, reminder_text, recurrence) in enumerate(reminders, 1):
+        repeat = " 🔁" if recurrence else ""
+        local_time = as_utc(reminder_time).astimezone(tz)
+        lines.append(f"{number}. {local_time.strftime('%Y-%m-%d %H:%M')}{repeat} {preview(reminder_text)}")
+        keyboard.append([InlineKeyboardButton(f"✏️ {number}", callback_data=encode_callback(CB_EDIT_REMINDER, reminder_id)),
+                         InlineKeyboardButton(f"❌ {number}", callback_data=encode_callback(CB_DELETE_REMINDER, reminder_id))])
+    has_prev = after is not None or (before is not None and has_more)
+    has_next = before is not None or has_more
+    first_id, first_time = reminders[0][:2]
+    last_id, last_time = reminders[-1][:2]
+    keyboard += page_navigation(has_prev, has_next,
+                                encode_callback(CB_REMINDERS_PAGE, period, 'p', *encode_reminder_cursor(first_time, first_id)),
+                                encode_callback(CB_REMINDERS_PAGE, period, 'n', *encode_reminder_cursor(last_time, last_id)))
+    await query.edit_message_text(text="\n".join(lines), reply_markup=InlineKeyboardMarkup(keyboard))
 
 # Отображение напоминаний на сегодня
 async def today_reminders(update: Update, context) -> None:
-    user_id = update.callback_query.from_user.id
-    today = datetime.now().date()
-    reminders = get_reminders_by_date(user_id, today)
-    await show_reminders(update, context, reminders, "напоминаний на сегодня")
+    await show_reminders(update, context, 'today')
 
 # Отображение напоминаний на завтра
 async def tomorrow_reminders(update: Update, context) -> None:
-    user_id = update.callback_query.from_user.id
-    tomorrow = (datetime.now() + timedelta(days=1)).date()
-    reminders = get_reminders_by_date(user_id, tomorrow)
-    await show_reminders(update, context, reminders, "напоминаний на завтра")
+    await show_reminders(update, context, 'tomorrow')
 
 # Отображение напоминаний на неделю
 async def week_reminders(update: Update, context) -> None:
-    user_id = update.callback_query.from_user.id
-    reminders = get_reminders_for_week(user_id)
-    await show_reminders(update, context, reminders, "напоминаний на неделю")
+    await show_reminders(update, context, 'week')
 
 # Отображение прошедших напоминаний
 async def past_reminders(update: Update, context) -> None:
-    user_id = update.callback_query.from_user.id
-    reminders = get_past_reminders(user_id)
-    await show_reminders(update, context, reminders, "прошедших напоминаний")
+    await show_reminders(update, context, 'past')
 
-# Обработка нажатий на кнопки редактирования и удаления
-async def button(update: Update, context) -> None:
+# Листание напоминаний: rp:<период>:<n|p>:<время в микросекундах>:<id>
+async def reminders_page(update: Update, context) -> None:
+    period, direction, micros, reminder_id = callback_args(update.callback_query)
+    cursor = decode_reminder_cursor(micros, reminder_id)
+    if direction == 'n':
+        await show_reminders(update, context, period, after=cursor)
+    else:
+        await show_reminders(update, context, period, before=cursor)
+
+# Кнопка редактирования заметки: ne:<id>
+async def edit_note_button(update: Update, context) -> None:
     query = update.callback_query
-    await query.answer()
-    user_id = query.from_user.id
-    callback_data = query.data
-
-    if callback_data.startswith('edit_note_'):
-        note_text = callback_data.split('_', 2)[2]
-        context.user_data['action'] = ACTION_EDIT_NOTE
-        context.user_data['note_to_edit'] = note_text
-        await query.edit_message_text(text=f"Редактируем заметку: {note_text}\nВведите новый текст заметки:")
-    elif callback_data.startswith('delete_note_'):
-        note_text = callback_data.split('_', 2)[2]
-        delete_note(user_id, note_text)
+    note_id = int(callback_args(query)[0])
+    note = await run_db(get_note, query.from_user.id, note_id)
+    if note is None:
+        await query.edit_message_text(text="Заметка не найдена.")
+        return
+    context.user_data['action'] = ACTION_EDIT_NOTE
+    context.user_data['note_to_edit'] = note_id
+    await query.edit_message_text(text=f"Редактируем заметку: {note[2]}\nВведите новый текст заметки:")
+
+# Кнопка удаления заметки: nd:<id>
+async def delete_note_button(update: Update, context) -> None:
+    query = update.callback_query
+    note_text = await run_db(delete_note, query.from_user.id, int(callback_args(query)[0]))
+    if note_text is None:
+        await query.edit_message_text(text="Заметка не найдена.")
+    else:
         await query.edit_message_text(text=f"Заметка удалена: {note_text}")
-    elif callback_data.startswith('edit_reminder_'):
-        reminder_text = callback_data.split('_', 2)[2]
-        context.user_data['action'] = ACTION_EDIT_REMINDER
-        context.user_data['reminder_to_edit'] = reminder_text
-        await query.edit_message_text(text=f"Редактируем напоминание: {reminder_text}\nВведите новый текст и время:")
-    elif callback_data.startswith('delete_reminder_'):
-        reminder_text = callback_data.split('_', 2)[2]
-        delete_reminder(user_id, reminder_text)
+
+# Кнопка редактирования напоминания: re:<id>
+async def edit_reminder_button(update: Update, context) -> None:
+    query = update.callback_query
+    reminder_id = int(callback_args(query)[0])
+    reminder = await run_db(get_reminder, query.from_user.id, reminder_id)
+    if reminder is None:
+        await query.edit_message_text(text="Напоминание не найдено.")
+        return
+    context.user_data['action'] = ACTION_EDIT_REMINDER
+    context.user_data['reminder_to_edit'] = reminder_id
+    await query.edit_message_text(text=f"Редактируем напоминание: {reminder[2]}\nВведите новый текст и время:")
+
+# Кнопка удаления напоминания: rd:<id>
+async def delete_reminder_button(update: Update, context) -> None:
+    query = update.callback_query
+    reminder_id = int(callback_args(query)[0])
+    reminder_text = await run_db(delete_reminder, query.from_user.id, reminder_id)
+    reminder_scheduler.discard(reminder_id)
+    if reminder_text is None:
+        await query.edit_message_text(text="Напоминание не найдено.")
+    else:
         await query.edit_message_text(text=f"Напоминание удалено: {reminder_text}")
-    elif callback_data == ACTION_ADD_NOTE:
-        await query.edit_message_text(text="Введите заметку в формате: #тег текст заметки")
-        context.user_data['action'] = ACTION_ADD_NOTE
-    elif callback_data == ACTION_ADD_REMINDER:
-        await query.edit_message_text(text="Введите напоминание в формате: текст напоминания - дата и время")
-        context.user_data['action'] = ACTION_ADD_REMINDER
-    elif callback_data == 'notes_menu':
-        await notes_menu(update, context)
-    elif callback_data == 'reminders_menu':
-        await reminders_menu(update, context)
-    elif callback_data == 'all_tags':
-        await all_tags(update, context)
-    elif callback_data == 'all_notes':
-        await all_notes(update, context)
-    elif callback_data == 'today_reminders':
-        await today_reminders(update, context)
-    elif callback_data == 'tomorrow_reminders':
-        await tomorrow_reminders(update, context)
-    elif callback_data == 'week_reminders':
-        await week_reminders(update, context)
-    elif callback_data == 'past_reminders':
-        await past_reminders(update, context)
-    elif callback_data.startswith('tag_'):
-        await show_notes_by_tag(update, context)
-
-# Указываем ваш часовой пояс (UTC+3)
-MY_TIMEZONE = timezone(timedelta(hours=3))
 
+# Кнопка "Добавить заметку"
+async def add_note_button(update: Update, context) -> None:
+    await update.callback_query.edit_message_text(text="Введите заметку в формате: #тег текст заметки")
+    context.user_data['action'] = ACTION_ADD_NOTE
+
+# Кнопка "Добавить напоминание"
+async def add_reminder_button(update: Update, context) -> None:
+    await update.callback_query.edit_message_text(text="Введите напоминание в формате: текст напоминания - дата и время")
+    context.user_data['action'] = ACTION_ADD_REMINDER
+
+# Команда /export [csv]: файл со всеми заметками и напоминаниями (по умолчанию JSON Lines)
+@timed_handler
+async def export_command(update: Update, context) -> None:
+    user_id = update.effective_user.id
+    file_format = 'csv' if context.args and context.args[0].lower() == 'csv' else 'json'
+    with tempfile.TemporaryFile() as out:
+        count = await run_db(export_user_data, user_id, out, file_format)
+        if not count:
+            await update.message.reply_text("У вас нет заметок и напоминаний для выгрузки.")
+            return
+        out.seek(0)
+        extension = 'csv' if file_format == 'csv' else 'jsonl'
+        await update.message.reply_document(document=out, filename=f"organizer_{user_id}.{extension}",
+                                            caption=f"Выгружено записей: {count}")
+
+# Команда /import: бот ждет файл в формате выгрузки (можно сразу отправить файл с подписью /import)
+@timed_handler
+async def import_command(update: Update, context) -> None:
+    context.user_data['action'] = ACTION_IMPORT
+    await update.message.reply_text("Отправьте файл .jsonl или .csv в формате команды /export.")
+
+# Прием файла для загрузки заметок и напоминаний
+@timed_handler
+async def handle_document(update: Update, context) -> None:
+    user_id = update.effective_user.id
+    document = update.message.document
+    if context.user_data.get('action') != ACTION_IMPORT and not (update.message.caption or '').startswith('/import'):
+        await update.message.reply_text("Чтобы загрузить заметки и напоминания из файла, используйте /import.")
+        return
+    context.user_data.pop('action', None)
+    if document.file_size and document.file_size > IMPORT_MAX_FILE_SIZE:
+        await update.message.reply_text("Файл слишком большой, максимум 20 МБ.")
+        return
+
+    file_format = 'csv' if (document.file_name or '').lower().endswith('.csv') else 'json'
+    tz = await user_timezone(user_id)
+    with tempfile.TemporaryFile() as source:
+        telegram_file = await document.get_file()
+        await telegram_file.download_to_memory(out=source)
+        source.seek(0)
+        try:
+            notes_count, reminders, skipped = await run_db(import_user_data, user_id, source, file_format, tz)
+        except Exception as e:
+            logger.error(f"Ошибка при загрузке данных пользователя {user_id}: {e}")
+            await update.message.reply_text("Произошла ошибка при загрузке, часть записей могла не сохраниться.")
+            return
+    reminder_scheduler.load(reminders)
+    text = f"Загружено заметок: {notes_count}, напоминаний: {len(reminders)}."
+    if skipped:
+        text += f"\nПропущено записей: {skipped} (неверный формат или прошедшие напоминания)."
+    await update.message.reply_text(text)
+
+# Кнопка "Поиск заметок"
+async def find_note_button(update: Update, context) -> None:
+    await update.callback_query.edit_message_text(text="Введите текст или тег для поиска:")
+    context.user_data['action'] = ACTION_SEARCH_NOTES
+
+# Таблица маршрутов для кнопок: код из callback_data -> обработчик
+CALLBACK_ROUTES = {
+    ACTION_ADD_NOTE: add_note_button,
+    ACTION_ADD_REMINDER: add_reminder_button,
+    'notes_menu': notes_menu,
+    'reminders_menu': reminders_menu,
+    'all_tags': all_tags,
+    'all_notes': all_notes,
+    'find_note': find_note_button,
+    'today_reminders': today_reminders,
+    'tomorrow_reminders': tomorrow_reminders,
+    'week_reminders': week_reminders,
+    'past_reminders': past_reminders,
+    CB_EDIT_NOTE: edit_note_button,
+    CB_DELETE_NOTE: delete_note_button,
+    CB_EDIT_REMINDER: edit_reminder_button,
+    CB_DELETE_REMINDER: delete_reminder_button,
+    CB_TAG: show_notes_by_tag,
+    CB_NOTES_PAGE: notes_page,
+    CB_REMINDERS_PAGE: reminders_page,
+    CB_SEARCH_PAGE: search_page,
+}
+
+# Обработка нажатий на кнопки: поиск обработчика по коду действия в таблице маршрутов
+@timed_handler
+async def button(update: Update, context) -> None:
+    query = update.callback_query
+    code = query.data.split(':', 1)[0]
+    handler = CALLBACK_ROUTES.get(code)
+    if handler is None:
+        # Кнопка из старого сообщения или действие, которого больше нет
+        await query.answer("Кнопка устарела, откройте меню заново.")
+        return
+    await query.answer()
+    started = time.perf_counter()
+    try:
+        await handler(update, context)
+    finally:
+        CALLBACK_SECONDS.observe(time.perf_counter() - started, code)
+
+# Частые форматы времени разбираются регулярными выражениями без dateparser
+DAY_OFFSETS = {'сегодня': 0, 'завтра': 1, 'послезавтра': 2}
+RE_DAY_AND_TIME = re.compile(r'^(сегодня|завтра|послезавтра)(?: в)? (\d{1,2}):(\d{2})$')
+RE_DATE_AND_TIME = re.compile(r'^(\d{1,2})\.(\d{1,2})(?:\.(\d{4}|\d{2}))?(?: в)? (\d{1,2}):(\d{2})$')
+RE_TIME = re.compile(r'^(?:в )?(\d{1,2}):(\d{2})$')
+RE_IN_INTERVAL = re.compile(r'^через(?: (\d+))? (минуту|минуты|минут|час|часа|часов|день|дня|дней|неделю|недели|недель)$')
+INTERVAL_UNITS = {
+    'минуту': 'minutes', 'минуты': 'minutes', 'минут': 'minutes',
+    'час': 'hours', 'часа': 'hours', 'часов': 'hours',
+    'день': 'days', 'дня': 'days', 'дней': 'days',
+    'неделю': 'weeks', 'недели': 'weeks', 'недель': 'weeks',
+}
+# Выражения, результат которых сдвигается вместе с текущим временем
+RE_RELATIVE = re.compile(r'через|назад|спустя|сейчас')
+RE_CLOCK = re.compile(r'\d{1,2}[:.]\d{2}')
+
+def parse_fast(text, now):
+    try:
+        match = RE_DAY_AND_TIME.match(text)
+        if match:
+            day = now + timedelta(days=DAY_OFFSETS[match.group(1)])
+            return day.replace(hour=int(match.group(2)), minute=int(match.group(3)), second=0, microsecond=0)
+        match = RE_DATE_AND_TIME.match(text)
+        if match:
+            day, month, year, hour, minute = match.groups()
+            year = now.year if year is None else int(year) + (2000 if len(year) == 2 else 0)
+            return now.replace(year=year, month=int(month), day=int(day), hour=int(hour), minute=int(minute),
+                               second=0, microsecond=0)
+        match = RE_TIME.match(text)
+        if match:
+            return now.replace(hour=int(match.group(1)), minute=int(match.group(2)), second=0, microsecond=0)
+        match = RE_IN_INTERVAL.match(text)
+        if match:
+            amount = int(match.group(1) or 1)
+            return now + timedelta(**{INTERVAL_UNITS[match.group(2)]: amount})
+    except ValueError:
+        # Несуществующая дата или время (например, 31.02) - пусть разбирается dateparser
+        return None
+    return None
+
+
+# Повторяющиеся напоминания: "каждый день в 9:00", "по будням в 9:00", "каждый понедельник в 10:00",
+# "каждую неделю в 9:00", "каждый месяц 15 числа в 12:00", "каждые 2 дня в 8:00" и правило RRULE как есть
+WEEKDAYS = {
+    'понедельник': 'MO', 'вторник': 'TU', 'среду': 'WE', 'четверг': 'TH', 'пятницу': 'FR', 'субботу': 'SA', 'воскресенье': 'SU',
+    'понедельникам': 'MO', 'вторникам': 'TU', 'средам': 'WE', 'четвергам': 'TH', 'пятницам': 'FR', 'субботам': 'SA',
+    'воскресеньям': 'SU',
+}
+RECURRENCE_TIME = r'(?: в)? (\d{1,2}):(\d{2})$'
+RECURRENCE_PATTERNS = [
+    (re.compile(r'^(?:каждый день|ежедневно)' + RECURRENCE_TIME), lambda match: 'FREQ=DAILY'),
+    (re.compile(r'^по будням' + RECURRENCE_TIME), lambda match: 'FREQ=WEEKLY;BYDAY=MO,TU,WE,TH,FR'),
+    (re.compile(r'^по выходным' + RECURRENCE_TIME), lambda match: 'FREQ=WEEKLY;BYDAY=SA,SU'),
+    (re.compile(rf"^(?:каждый|каждую|каждое|по) ({'|'.join(WEEKDAYS)})" + RECURRENCE_TIME),
+     lambda match: f"FREQ=WEEKLY;BYDAY={WEEKDAYS[match.group(1)]}"),
+    (re.compile(r'^(?:каждую неделю|еженедельно)' + RECURRENCE_TIME), lambda match: 'FREQ=WEEKLY'),
+    (re.compile(r'^(?:каждый месяц|ежемесячно) (\d{1,2})(?:-?го)?(?: числа)?' + RECURRENCE_TIME),
+     lambda match: f"FREQ=MONTHLY;BYMONTHDAY={int(match.group(1))}"),
+    (re.compile(r'^каждые (\d+) (?:дня|дней)' + RECURRENCE_TIME), lambda match: f"FREQ=DAILY;INTERVAL={int(match.group(1))}"),
+    (re.compile(r'^каждые (\d+) (?:недели|недель)' + RECURRENCE_TIME), lambda match: f"FREQ=WEEKLY;INTERVAL={int(match.group(1))}"),
+]
+RE_RRULE = re.compile(r'^(?:rrule:)?(freq=\S+)$')
+RECURRENCE_NAMES = {
+    'FREQ=DAILY': "каждый день",
+    'FREQ=WEEKLY;BYDAY=MO,TU,WE,TH,FR': "по будням",
+    'FREQ=WEEKLY;BYDAY=SA,SU': "по выходным",
+    'FREQ=WEEKLY': "каждую неделю",
+}
+
+# Разбор повторяющегося времени: правило RRULE и первое срабатывание после now, либо None
+def parse_recurrence(text, now):
+    try:
+        for pattern, rule in RECURRENCE_PATTERNS:
+            match = pattern.match(text)
+            if match:
+                hour, minute = match.groups()[-2:]
+                recurrence = rule(match)
+                start = now.replace(hour=int(hour), minute=int(minute), second=0, microsecond=0)
+                # Правило отсчитывается от ближайшего наступления этого времени (важно для интервалов)
+                if start <= now:
+                    start += timedelta(days=1)
+                break
+        else:
+            match = RE_RRULE.match(text)
+            if not match:
+                return None
+            start = now.replace(second=0, microsecond=0)
+            recurrence = check_recurrence(match.group(1), start)
+        first = recurrence_rule(recurrence).replace(dtstart=start).after(now, inc=True)
+    except ValueError:
+        return None
+    if first is None:
+        return None
+    return first, recurrence
+
+def describe_recurrence(recurrence):
+    return RECURRENCE_NAMES.get(recurrence, recurrence)
+
+
+# Разбор времени напоминаний: быстрый путь на регулярных выражениях, затем один заранее настроенный
+# DateDataParser и LRU-кэш результатов dateparser для повторяющихся выражений
+class ReminderTimeParser:
+    def __init__(self, tz, memo_size=1024):
+        self.tz = tz
+        # Отдельный DateDataParser на каждый часовой пояс пользователей
+        self._parsers = {}
+        self._memo = OrderedDict()
+        self._memo_size = memo_size
+        self.fast_hits = 0
+        self.memo_hits = 0
+        self.dateparser_calls = 0
+
+    # Первый вызов dateparser загружает языковые данные - делаем это при запуске, а не на первом сообщении
+    def warm_up(self):
+        self._parser_for(self.tz).get_date_data("1 января 2000 10:00")
+
+    def _parser_for(self, tz):
+        parser = self._parsers.get(str(tz))
+        if parser is None:
+            parser = self._parsers[str(tz)] = dateparser.DateDataParser(languages=['ru'], settings={'TIMEZONE': str(tz)})
+        return parser
+
+    # Время в часовом поясе tz (по умолчанию - поясе парсера)
+    def parse(self, text, now=None, tz=None):
+        tz = tz or self.tz
+        now = now or datetime.now(tz)
+        text = ' '.join(text.lower().split())
+        result = parse_fast(text, now)
+        if result is not None:
+            self.fast_hits += 1
+            return result
+
+        memo_key = (str(tz), text)
+        memo = self._memo.get(memo_key)
+        # Результат из кэша годится в тот же день: относительные выражения сдвигаются на прошедшее время,
+        # остальные зависят только от текущей даты
+        if memo is not None and memo[0].date() == now.date():
+            self._memo.move_to_end(memo_key)
+            self.memo_hits += 1
+            base, result = memo
+            if result is not None and RE_RELATIVE.search(text) and not RE_CLOCK.search(text):
+                return result + (now - base)
+            return result
+
+        self.dateparser_calls += 1
+        result = self._parser_for(tz).get_date_data(text).date_obj
+        if result is not None:
+            if result.tzinfo is None:
+                result = result.replace(tzinfo=tz)
+            else:
+                result = result.astimezone(tz)
+        self._memo[memo_key] = (now, result)
+        self._memo.move_to_end(memo_key)
+        if len(self._memo) > self._memo_size:
+            self._memo.popitem(last=False)
+        return result
+
+    # Время напоминания и правило повторения (None для разового напоминания)
+    def parse_schedule(self, text, now=None, tz=None):
+        tz = tz or self.tz
+        now = now or datetime.now(tz)
+        recurring = parse_recurrence(' '.join(text.lower().split()), now)
+        if recurring is not None:
+            return recurring
+        return self.parse(text, now, tz), None
+
+
+reminder_time_parser = ReminderTimeParser(DEFAULT_TIMEZONE)
+
+# Смещение вида "+5", "UTC+5", "GMT-3" соответствует поясу Etc/GMT с обратным знаком
+# Имя часового пояса по вводу пользователя или None, если такого пояса нет: имя IANA
+# или смещение от UTC в виде UTC+05:30 (так оно и показывается пользователю)
+def resolve_timezone_name(text):
+    if text.upper() in ('UTC', 'GMT'):
+        return 'UTC'
+    if RE_UTC_OFFSET.match(text) or RE_ETC_GMT.match(text):
+        zone = fixed_offset_zone(text)
+        return str(zone) if zone is not None else None
+    try:
+        return str(ZoneInfo(text))
+    except (ZoneInfoNotFoundError, ValueError):
+        return None
+
+# Команда /timezone <пояс>: выбор часового пояса для разбора и вывода времени напоминаний
+@timed_handler
+async def timezone_command(update: Update, context) -> None:
+    user_id = update.effective_user.id
+    if not context.args:
+        tz = await user_timezone(user_id)
+        await update.message.reply_text(f"Ваш часовой пояс: {tz}, сейчас {datetime.now(tz).strftime('%H:%M')}.\n"
+                                        f"Изменить: /timezone Europe/Moscow или /timezone UTC+5")
+        return
+    timezone_name = resolve_timezone_name(context.args[0])
+    if timezone_name is None:
+        await update.message.reply_text("Неизвестный часовой пояс. Пример: /timezone Europe/Moscow или /timezone UTC+5")
+        return
+    await run_db(set_user_timezone, user_id, timezone_name)
+    tz = zone_or_default(timezone_name)
+    await update.message.reply_text(f"Часовой пояс установлен: {tz}, сейчас {datetime.now(tz).strftime('%H:%M')}.")
+
+@timed_handler
 async def handle_message(update: Update, context) -> None:
     user_id = update.message.from_user.id
     text = update.message.text
@@ -340,7 +2689,7 @@ async def handle_message(update: Update, context) -> None:
         if action == ACTION_ADD_NOTE:
             if '#' in text:
                 tag, note = text.split(' ', 1)
-                add_note(user_id, tag, note)
+                await run_db(add_note, user_id, tag, note)
                 await update.message.reply_text(f"Заметка добавлена с тегом {tag}:\n{note}")
             else:
                 await update.message.reply_text("Неверный формат. Используйте #тег текст заметки")
@@ -351,16 +2700,17 @@ async def handle_message(update: Update, context) -> None:
                     reminder_text = reminder_text.strip()
                     time_part = time_part.strip()
 
-                    # Парсим время с учетом локального времени пользователя
-                    reminder_time = dateparser.parse(time_part, languages=['ru'], settings={'TIMEZONE': 'UTC+3'})
+                    # Парсим время в часовом поясе пользователя
+                    tz = await user_timezone(user_id)
+                    reminder_time, recurrence = reminder_time_parser.parse_schedule(time_part, tz=tz)
                     
                     if reminder_time:
-                        # Явно устанавливаем часовой пояс UTC+3
-                        reminder_time = reminder_time.replace(tzinfo=MY_TIMEZONE)
                         # Преобразуем в UTC для хранения в базе данных
                         reminder_time_utc = reminder_time.astimezone(timezone.utc)
-                        add_reminder(user_id, reminder_time_utc, reminder_text)
-                        await update.message.reply_text(f"Напоминание добавлено на {reminder_time.strftime('%Y-%m-%d %H:%M')} (UTC+3):\n{reminder_text}")
+                        reminder_id = await run_db(add_reminder, user_id, reminder_time_utc, reminder_text, recurrence)
+                        reminder_scheduler.add(reminder_id, user_id, reminder_time_utc, reminder_text, recurrence)
+                        repeat = f"\nПовтор: {describe_recurrence(recurrence)}" if recurrence else ""
+                        await update.message.reply_text(f"Напоминание добавлено на {reminder_time.strftime('%Y-%m-%d %H:%M')} ({tz}):\n{reminder_text}{repeat}")
                     else:
                         await update.message.reply_text("Не удалось распознать дату и время. Попробуйте еще раз.")
                 else:
@@ -370,10 +2720,11 @@ async def handle_message(update: Update, context) -> None:
                 await update.message.reply_text("Произошла ошибка. Попробуйте еще раз.")
         elif action == ACTION_EDIT_NOTE:
             new_note_text = text
-            old_note_text = context.user_data.get('note_to_edit')
-            delete_note(user_id, old_note_text)
-            add_note(user_id, context.user_data.get('tag'), new_note_text)
-            await update.message.reply_text(f"Заметка отредактирована:\n{new_note_text}")
+            note_id = context.user_data.get('note_to_edit')
+            if await run_db(update_note, user_id, note_id, new_note_text):
+                await update.message.reply_text(f"Заметка отредактирована:\n{new_note_text}")
+            else:
+                await update.message.reply_text("Заметка не найдена.")
             context.user_data.pop('action')
             context.user_data.pop('note_to_edit')
         elif action == ACTION_EDIT_REMINDER:
@@ -383,18 +2734,20 @@ async def handle_message(update: Update, context) -> None:
                     new_reminder_text = new_reminder_text.strip()
                     time_part = time_part.strip()
 
-                    # Парсим время с учетом локального времени пользователя
-                    new_reminder_time = dateparser.parse(time_part, languages=['ru'], settings={'TIMEZONE': 'UTC+3'})
+                    # Парсим время в часовом поясе пользователя
+                    tz = await user_timezone(user_id)
+                    new_reminder_time, recurrence = reminder_time_parser.parse_schedule(time_part, tz=tz)
                     
                     if new_reminder_time:
-                        # Явно устанавливаем часовой пояс UTC+3
-                        new_reminder_time = new_reminder_time.replace(tzinfo=MY_TIMEZONE)
                         # Преобразуем в UTC для хранения в базе данных
                         new_reminder_time_utc = new_reminder_time.astimezone(timezone.utc)
-                        old_reminder_text = context.user_data.get('reminder_to_edit')
-                        delete_reminder(user_id, old_reminder_text)
-                        add_reminder(user_id, new_reminder_time_utc, new_reminder_text)
-                        await update.message.reply_text(f"Напоминание отредактировано на {new_reminder_time.strftime('%Y-%m-%d %H:%M')} (UTC+3):\n{new_reminder_text}")
+                        reminder_id = context.user_data.get('reminder_to_edit')
+                        if await run_db(update_reminder, user_id, reminder_id, new_reminder_time_utc, new_reminder_text, recurrence):
+                            reminder_scheduler.add(reminder_id, user_id, new_reminder_time_utc, new_reminder_text, recurrence)
+                            repeat = f"\nПовтор: {describe_recurrence(recurrence)}" if recurrence else ""
+                            await update.message.reply_text(f"Напоминание отредактировано на {new_reminder_time.strftime('%Y-%m-%d %H:%M')} ({tz}):\n{new_reminder_text}{repeat}")
+                        else:
+                            await update.message.reply_text("Напоминание не найдено.")
                     else:
                         await update.message.reply_text("Не удалось распознать дату и время. Попробуйте еще раз.")
                 else:
@@ -404,35 +2757,271 @@ async def handle_message(update: Update, context) -> None:
                 await update.message.reply_text("Произошла ошибка. Попробуйте еще раз.")
             context.user_data.pop('action')
             context.user_data.pop('reminder_to_edit')
+        elif action == ACTION_SEARCH_NOTES:
+            context.user_data.pop('action')
+            context.user_data['search_query'] = text.strip()
+            await show_search_results(update, context)
+        elif action == ACTION_IMPORT:
+            context.user_data.pop('action')
+            await update.message.reply_text("Ожидался файл .jsonl или .csv, загрузка отменена. Повторить: /import")
             
 async def check_reminders(context):
+    reminder_scheduler.job_fired()
     try:
         # Получаем текущее время в UTC
         now = datetime.now(timezone.utc)
         logger.info(f"Проверка напоминаний. Текущее время: {now}")
         
-        # Ищем напоминания, время которых наступило
-        with get_db_connection() as conn:
-            with conn.cursor() as c:
-                c.execute("SELECT user_id, reminder_text FROM reminders WHERE reminder_time <= %s", (now,))
-                reminders = c.fetchall()
+        # Берем из планировщика напоминания, время которых наступило
+        reminders = reminder_scheduler.pop_due(now)
         
         logger.info(f"Найдено напоминаний: {len(reminders)}")
         
-        # Отправляем уведомления и удаляем напоминания
+        # Передаем напоминания в конвейер отправки: он соблюдает лимиты Telegram
+        # и удаляет отправленные напоминания из базы пачками
         for reminder in reminders:
-            user_id, reminder_text = reminder
-            await context.bot.send_message(chat_id=user_id, text=f"⏰ Напоминание: {reminder_text}")
-            delete_reminder(user_id, reminder_text)  # Удаляем напоминание после отправки
+            await reminder_delivery.enqueue(reminder)
         
     except Exception as e:
         logger.error(f"Ошибка в check_reminders: {e}")
-        
+    finally:
+        # Взводим задачу на следующее напоминание
+        reminder_scheduler.arm()
+
+# Режим нескольких процессов: захват наступивших напоминаний своей части, пока есть место в очереди отправки.
+# В очереди держим не больше, чем успеет уйти за время аренды при лимите отправки
+async def claim_due_reminders(context):
+    loop = asyncio.get_running_loop()
+    budget = max(1, int(REMINDER_SEND_RATE * REMINDER_SEND_WINDOW))
+    try:
+        while True:
+            limit = min(reminder_delivery.capacity(), REMINDER_CLAIM_BATCH, budget - reminder_delivery.backlog())
+            if limit <= 0:
+                return
+            expires_at = loop.time() + REMINDER_SEND_WINDOW
+            reminders = await run_db(claim_reminders, REMINDER_SHARD, REMINDER_SHARDS, limit)
+            for reminder in reminders:
+                await reminder_delivery.enqueue(reminder, expires_at)
+            if len(reminders) < limit:
+                return
+    except Exception as e:
+        logger.error(f"Ошибка при захвате напоминаний: {e}")
+
+# Загрузка напоминаний из базы в планировщик при запуске бота.
+# Процесс роли updates напоминания не отправляет, в режиме нескольких процессов они захватываются из базы
+async def load_reminders(application) -> None:
+    if BOT_ROLE == 'updates':
+        return
+    if USE_REMINDER_CLAIMS:
+        reminder_delivery.start(application.bot)
+        application.job_queue.run_repeating(claim_due_reminders, interval=REMINDER_POLL_INTERVAL, first=0)
+        logger.info(f"Отправка напоминаний части {REMINDER_SHARD} из {REMINDER_SHARDS}")
+        return
+    reminders = await run_db(get_pending_reminders)
+    reminder_scheduler.load(reminders)
+    reminder_delivery.start(application.bot)
+    reminder_scheduler.attach(application.job_queue)
+    logger.info(f"Загружено напоминаний в планировщик: {len(reminder_scheduler)}")
+
+# Периодический вывод статистики хранилища, отправки напоминаний и кэша заметок
+async def log_stats(context):
+    stats = get_storage().stats()
+    logger.info(f"Хранилище: {stats}")
+    if stats.get('timeouts_total') or stats.get('saturation', 0) >= 1:
+        logger.warning("Пул соединений с БД исчерпан, увеличьте DB_POOL_MAX_SIZE")
+    logger.info(f"Отправка напоминаний: {reminder_delivery.stats()}")
+    logger.info(f"Кэш заметок: {notes_cache.stats()}")
+    if context.application.persistence:
+        logger.info(f"Состояние пользователей: {context.application.persistence.stats()}")
+
+# Показатели очереди напоминаний, хранилища и кэша обновляются при каждом запросе метрик
+@metrics.collector
+def collect_runtime_metrics():
+    delivery = reminder_delivery.stats()
+    REMINDER_QUEUE_DEPTH.set(delivery['queue_depth'])
+    REMINDER_PENDING_ACKS.set(delivery['pending_acks'])
+    for name, value in get_storage().stats().items():
+        if isinstance(value, (int, float)):
+            STORAGE_STATS.set(value, name)
+    for name, value in notes_cache.stats().items():
+        if isinstance(value, (int, float)):
+            NOTES_CACHE_STATS.set(value, name)
+
+async def metrics_handler(request):
+    return web.Response(text=metrics.render(), headers={'Content-Type': 'text/plain; version=0.0.4; charset=utf-8'})
+
+_metrics_runner = None
+
+# HTTP-сервер метрик для Prometheus, работает только при заданном METRICS_PORT
+async def start_metrics_server():
+    global _metrics_runner
+    if not metrics.enabled:
+        return
+    web_app = web.Application()
+    web_app.router.add_get('/metrics', metrics_handler)
+    _metrics_runner = web.AppRunner(web_app)
+    await _metrics_runner.setup()
+    await web.TCPSite(_metrics_runner, METRICS_LISTEN, METRICS_PORT).start()
+    logger.info(f"Метрики доступны на {METRICS_LISTEN}:{METRICS_PORT}/metrics")
+
+async def stop_metrics_server():
+    global _metrics_runner
+    if _metrics_runner is not None:
+        await _metrics_runner.cleanup()
+        _metrics_runner = None
+
+# Запуск служб бота после инициализации приложения
+async def startup(application) -> None:
+    await load_reminders(application)
+    await start_metrics_server()
+
+# Освобождение ресурсов при остановке бота
+async def shutdown(application) -> None:
+    await stop_metrics_server()
+    await reminder_delivery.stop()
+    _db_executor.shutdown(wait=True)
+    close_storage()
+
+# Прием обновлений от Telegram по HTTP: проверяем секретный токен и передаем обновление в очередь приложения
+async def webhook_handler(request):
+    application = request.app['application']
+    if WEBHOOK_SECRET_TOKEN and request.headers.get('X-Telegram-Bot-Api-Secret-Token') != WEBHOOK_SECRET_TOKEN:
+        return web.Response(status=403)
+    try:
+        data = await request.json()
+    except ValueError:
+        return web.Response(status=400)
+    # Тело - корректный JSON, но не объект обновления: отвечаем 400, а не необработанной ошибкой 500
+    if not isinstance(data, dict):
+        return web.Response(status=400)
+    try:
+        update = Update.de_json(data, application.bot)
+    except Exception as e:
+        logger.warning(f"Некорректное обновление в вебхуке: {e}")
+        return web.Response(status=400)
+    if update is None:
+        return web.Response(status=400)
+    await application.update_queue.put(update)
+    return web.Response()
+
+# Работа приложения без polling до SIGINT/SIGTERM; on_started и on_stopping запускают и останавливают
+# дополнительные службы (например, HTTP-сервер вебхука)
+async def run_until_stopped(application, on_started=None, on_stopping=None):
+    stop_event = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop_event.set)
+
+    await application.initialize()
+    if application.post_init:
+        await application.post_init(application)
+    await application.start()
+    try:
+        if on_started:
+            await on_started()
+        await stop_event.wait()
+    finally:
+        if on_stopping:
+            await on_stopping()
+        await application.stop()
+        await application.shutdown()
+        if application.post_shutdown:
+            await application.post_shutdown(application)
+
+# Запуск бота в режиме вебхука на aiohttp-сервере.
+# Проверить локально: BOT_MODE=webhook без WEBHOOK_URL и отправить JSON обновления POST-запросом на WEBHOOK_PATH
+async def run_webhook(application):
+    web_app = web.Application()
+    web_app['application'] = application
+    web_app.router.add_post(WEBHOOK_PATH, webhook_handler)
+    runner = web.AppRunner(web_app)
+
+    async def start_server():
+        if WEBHOOK_URL:
+            await application.bot.set_webhook(url=WEBHOOK_URL, secret_token=WEBHOOK_SECRET_TOKEN,
+                                              allowed_updates=Update.ALL_TYPES)
+        await runner.setup()
+        await web.TCPSite(runner, WEBHOOK_LISTEN, WEBHOOK_PORT).start()
+        logger.info(f"Вебхук слушает {WEBHOOK_LISTEN}:{WEBHOOK_PORT}{WEBHOOK_PATH}")
+
+    await run_until_stopped(application, start_server, runner.cleanup)
+
+# Проверка настроек ролей и частей до запуска
+def check_worker_config():
+    if BOT_ROLE not in ('all', 'updates', 'reminders'):
+        raise ValueError(f"Неизвестная роль BOT_ROLE={BOT_ROLE}, допустимы all, updates, reminders")
+    if not 0 <= REMINDER_SHARD < REMINDER_SHARDS:
+        raise ValueError(f"REMINDER_SHARD должен быть от 0 до {REMINDER_SHARDS - 1}")
+    if USE_REMINDER_CLAIMS and STORAGE_BACKEND == 'sqlite':
+        raise ValueError("С SQLite бот работает только одним процессом: BOT_ROLE=all, REMINDER_SHARDS=1 и BOT_REPLICAS=1")
+    if BOT_REPLICAS < 1:
+        raise ValueError("BOT_REPLICAS должен быть не меньше 1")
+    # Копии, обрабатывающие обновления, должны видеть состояние диалогов, сохраненное другими копиями
+    if MULTIPLE_REPLICAS and BOT_ROLE != 'reminders' and USER_STATE_REFRESH_TTL <= 0:
+        raise ValueError("При BOT_REPLICAS > 1 задайте USER_STATE_REFRESH_TTL (1-5 секунд)")
+
+# Запуск процессов отправки напоминаний для всех частей на этой машине.
+# Каждый процесс получает свой REMINDER_SHARD (и свой порт метрик) через окружение
+def run_reminder_shards():
+    context = multiprocessing.get_context('spawn')
+    processes = []
+    for shard in range(REMINDER_SHARDS):
+        os.environ['REMINDER_SHARD'] = str(shard)
+        if METRICS_PORT:
+            os.environ['METRICS_PORT'] = str(METRICS_PORT + shard)
+        process = context.Process(target=main, name=f"reminders-{shard}")
+        process.start()
+        processes.append(process)
+    # SIGTERM (остановка контейнера) передаем процессам частей, они завершаются штатно
+    signal.signal(signal.SIGTERM, lambda signum, frame: [process.terminate() for process in processes])
+    for process in processes:
+        while process.is_alive():
+            try:
+                process.join()
+            except KeyboardInterrupt:
+                # Ctrl+C получают все процессы группы - ждем их завершения
+                continue
+
+# Создание приложения с поддержкой JobQueue и всеми обработчиками.
+# base_url позволяет направить запросы к Bot API на другой сервер (используется в нагрузочных тестах)
+def build_application(token, base_url=None):
+    builder = (
+        ApplicationBuilder()
+        .token(token)
+        .concurrent_updates(BOT_CONCURRENT_UPDATES or False)
+        .post_init(startup)
+        .post_shutdown(shutdown)
+    )
+    if BOT_ROLE != 'reminders':
+        builder = builder.persistence(DbPersistence(USER_STATE_FLUSH_INTERVAL, USER_STATE_REFRESH_TTL))
+    if base_url:
+        builder = builder.base_url(base_url)
+    application = builder.build()
+
+    # Напоминания отправляет планировщик, задача взводится в load_reminders
+    application.job_queue.run_repeating(log_stats, interval=DB_POOL_STATS_INTERVAL, first=DB_POOL_STATS_INTERVAL)
+    # Процесс роли reminders не получает обновлений
+    if BOT_ROLE == 'reminders':
+        return application
+
+    # Добавление обработчиков
+    application.add_handler(CommandHandler("start", start))
+    application.add_handler(CommandHandler("search", search_command))
+    application.add_handler(CommandHandler("timezone", timezone_command))
+    application.add_handler(CommandHandler("export", export_command))
+    application.add_handler(CommandHandler("import", import_command))
+    application.add_handler(MessageHandler(filters.Document.ALL, handle_document))
+    application.add_handler(CallbackQueryHandler(button))
+    application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_message))
+    return application
+
 # Основная функция
 def main() -> None:
+    check_worker_config()
     # удаление бд     drop_tables() 
     # Инициализация базы данных
     init_db()
+    reminder_time_parser.warm_up()
 
     # Получение токена из переменной окружения
     TELEGRAM_BOT_TOKEN = os.getenv("TELEGRAM_BOT_TOKEN")
@@ -441,19 +3030,19 @@ def main() -> None:
     if not TELEGRAM_BOT_TOKEN:
         raise ValueError("Токен Telegram-бота не задан. Убедитесь, что переменная окружения TELEGRAM_BOT_TOKEN установлена.")
 
-    # Создание приложения с поддержкой JobQueue
-    application = ApplicationBuilder().token(TELEGRAM_BOT_TOKEN).build()
+    if BOT_ROLE == 'reminders' and REMINDER_SHARDS > 1 and os.getenv("REMINDER_SHARD") is None:
+        run_reminder_shards()
+        return
 
-    # Добавление обработчиков
-    application.add_handler(CommandHandler("start", start))
-    application.add_handler(CallbackQueryHandler(button))
-    application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_message))
-
-    # Добавление фоновой задачи для проверки напоминаний
-    application.job_queue.run_repeating(check_reminders, interval=60.0, first=0.0)
+    application = build_application(TELEGRAM_BOT_TOKEN)
 
     # Запуск бота
-    application.run_polling()
+    if BOT_ROLE == 'reminders':
+        asyncio.run(run_until_stopped(application))
+    elif BOT_MODE == 'webhook':
+        asyncio.run(run_webhook(application))
+    else:
+        application.run_polling()
 
 if __name__ == '__main__':
     main()